@@ -1,75 +1,338 @@
 # app.py
+from flask import Flask, Response, current_app, make_response, request, render_template, session, redirect, url_for, jsonify, stream_with_context, g
+import hashlib
+import hmac
 import logging
-from flask import Flask, request, render_template, session, redirect, url_for
-import pyotp
 import os
-from modules.storage import get_all_payment_requests
+import secrets
+import time
+from datetime import datetime
+from functools import lru_cache
+from modules import metrics
+from modules.logging_setup import setup_logging
+from modules.auth_guard import TotpVerifier, LoginLimiter, is_code_format
+from modules.storage import ensure_db, set_query_observer, get_payment_requests_page, get_all_tutors, iter_payment_requests, get_payment_totals, bulk_upsert_reference, get_data_revision, PAGE_SIZE
+from modules.payments_export import EXPORT_FORMATS, export_lines
+from modules.reference_import import parse_reference, merge_reference
 
-app = Flask(__name__, static_folder='static', template_folder='templates')
+# Файлы статики по адресу с отпечатком содержимого (?v=...) кэшируются браузером на год
+STATIC_MAX_AGE = 365 * 24 * 3600
 
-app.secret_key = os.environ.get('FLASK_SECRET_KEY')
-if not app.secret_key:
-    raise ValueError("Не задана переменная окружения FLASK_SECRET_KEY")
+# Статусы платежей, по которым можно фильтровать журнал
+PAYMENT_STATUSES = ['NEW', 'COMPLETE', 'CANCEL']
 
-TOTP_SECRET = os.environ.get('TOTP_SECRET')
-if not TOTP_SECRET:
-    raise ValueError("Не задана переменная окружения TOTP_SECRET")
-
-# Настройка логирования
+# Настройка логирования (запись в файл — в фоновом потоке, настраивается в create_app)
 LOG_DIR = './logs'
 LOG_FILE = os.path.join(LOG_DIR, 'tutorApp.log')
 logger = logging.getLogger('tutorApp')
-logger.setLevel(logging.INFO)
-
-# Проверяем, есть ли уже обработчики
-if not logger.handlers:
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    file_handler = logging.FileHandler(LOG_FILE, encoding='utf-8', mode='a')
-    file_handler.setFormatter(formatter)
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+
+def create_app():
+    """Создаёт веб-приложение. БД готовится при первом запросе, а не при импорте модуля"""
+    app = Flask(__name__, static_folder='static', template_folder='templates')
+
+    app.secret_key = os.environ.get('FLASK_SECRET_KEY')
+    if not app.secret_key:
+        raise ValueError("Не задана переменная окружения FLASK_SECRET_KEY")
+    # Cookie сессии не уходит с POST-запросами с чужих сайтов; формы дополнительно защищены csrf_token
+    app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+
+    totp_secret = os.environ.get('TOTP_SECRET')
+    if not totp_secret:
+        raise ValueError("Не задана переменная окружения TOTP_SECRET")
+    # Проверка кодов и блокировка подбора живут в памяти процесса, поэтому gunicorn запускается с одним процессом (--workers 1)
+    app.extensions['totp'] = TotpVerifier(totp_secret)
+    app.extensions['login_limiter'] = LoginLimiter()
+
+    # За обратным прокси IP клиента берётся из X-Forwarded-For (PROXY_COUNT — число прокси перед приложением)
+    proxy_count = int(os.environ.get('PROXY_COUNT', 0))
+    if proxy_count:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_count)
+
+    setup_logging('tutorApp', LOG_FILE)
+
+    # Метрики: время обработки запросов и функций storage, отдаются на /metrics
+    # администратору после входа или сборщику с заголовком "Authorization: Bearer METRICS_TOKEN"
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+    set_query_observer(metrics.observe_storage)
+    app.before_request(start_request_timer)
+    app.after_request(observe_request)
+    app.after_request(cache_static)
+
+    app.add_template_global(static_url)
+    app.add_template_global(csrf_token)
+    app.add_template_filter(format_date, 'ru_date')
+
+    # Схема проверяется один раз на процесс; дальше ensure_db ничего не стоит
+    app.before_request(ensure_db)
+
+    register_routes(app)
+    return app
+
+def register_routes(app):
+    app.add_url_rule('/metrics', view_func=metrics_endpoint)
+    app.add_url_rule('/', view_func=index)
+    app.add_url_rule('/login', view_func=login)
+    app.add_url_rule('/auth', view_func=auth, methods=['POST'])
+    app.add_url_rule('/payments', view_func=payments)
+    app.add_url_rule('/payments.json', view_func=payments_json)
+    app.add_url_rule('/payments/export', view_func=payments_export)
+    app.add_url_rule('/reference/upload', view_func=reference_upload, methods=['POST'])
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+def observe_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        metrics.registry.observe('tutor_http_request_duration_seconds', time.perf_counter() - started,
+                                 endpoint=request.endpoint or 'unknown', status=str(response.status_code))
+    return response
+
+def cache_static(response):
+    """Статика с отпечатком в адресе неизменна: при изменении файла меняется и адрес"""
+    if request.endpoint == 'static' and request.args.get('v') and response.status_code == 200:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+@lru_cache(maxsize=None)
+def file_fingerprint(path):
+    """Короткий хэш содержимого файла (None, если файла нет); считается один раз на процесс"""
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()[:10]
+    except OSError:
+        return None
+
+@lru_cache(maxsize=None)
+def static_fingerprint(folder):
+    """Общий отпечаток всех файлов статики: меняется, если поменялся адрес хотя бы одного static_url(...)"""
+    paths = sorted(os.path.join(root, name) for root, _, names in os.walk(folder) for name in names)
+    fingerprints = [(os.path.relpath(path, folder), file_fingerprint(path)) for path in paths]
+    return hashlib.md5(repr(fingerprints).encode('utf-8')).hexdigest()[:10]
+
+def static_url(filename):
+    """Адрес файла статики с отпечатком содержимого: {{ static_url('style.css') }}"""
+    version = file_fingerprint(os.path.join(current_app.static_folder, filename))
+    if version is None:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=filename, v=version)
+
+def format_date(value):
+    """Фильтр шаблонов ru_date: "2025-11-20 17:50:11" → "20.11.2025"""
+    date_part = (value or '').split(' ')[0]
+    year, _, rest = date_part.partition('-')
+    month, _, day = rest.partition('-')
+    return f"{day}.{month}.{year}" if day else value
+
+def metrics_endpoint():
+    if not (is_logged_in() or metrics.scrape_allowed(request.headers.get('Authorization'), current_app.config['METRICS_TOKEN'])):
+        return 'Unauthorized', 401, {'WWW-Authenticate': 'Bearer'}
+    return metrics.registry.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
 def generate_totp():
-    totp = pyotp.TOTP(TOTP_SECRET)
-    return totp.now()
+    return current_app.extensions['totp'].now()
 
 def verify_totp(token):
-    totp = pyotp.TOTP(TOTP_SECRET)
-    return totp.verify(token)
+    return current_app.extensions['totp'].verify(token)
+
+def csrf_token():
+    """Токен для форм администратора: один на сессию, подставляется в шаблон скрытым полем"""
+    return session.setdefault('csrf_token', secrets.token_hex(16))
+
+def csrf_valid():
+    expected = session.get('csrf_token')
+    received = request.form.get('csrf_token', '')
+    return bool(expected) and hmac.compare_digest(received.encode('utf-8'), expected.encode('utf-8'))
 
-@app.route('/')
 def index():
     if not is_logged_in():
         return redirect(url_for('login'))
-    return render_template('index.html')
+    totals = {scope: get_payment_totals(scope) for scope in ('month', 'student', 'tutor')}
+    return render_template('index.html', totals=totals, imported=request.args.get('imported'),
+                           import_error=request.args.get('import_error'))
 
-@app.route('/login')
 def login():
+    # Идентификатор сессии для ограничения попыток входа
+    session.setdefault('login_id', secrets.token_hex(8))
     return render_template('login.html')
 
-@app.route('/auth', methods=['POST'])
 def auth():
-    token = request.form.get('otp')
-    if verify_totp(token):
+    limiter = current_app.extensions['login_limiter']
+    keys = (('ip', request.remote_addr), ('session', session.setdefault('login_id', secrets.token_hex(8))))
+    # Сначала дешёвые проверки: блокировка и формат кода, HMAC считается только после них
+    wait = limiter.retry_after(*keys)
+    if wait:
+        logger.warning("Вход заблокирован для %s ещё на %d с", request.remote_addr, wait)
+        return redirect(url_for('login', error='locked'))
+
+    token = request.form.get('otp', '').strip()
+    if is_code_format(token) and verify_totp(token):
+        limiter.reset(*keys)
         session['logged_in'] = True
         return redirect(url_for('index'))
-    else:
-        # Перенаправляем обратно на login с параметром ошибки
-        return redirect(url_for('login', error='invalid'))
 
-@app.route('/payments')
+    limiter.fail(*keys)
+    logger.warning("Неудачная попытка входа с %s", request.remote_addr)
+    # Перенаправляем обратно на login с параметром ошибки
+    return redirect(url_for('login', error='invalid'))
+
 def payments():
     if not is_logged_in():
         return redirect(url_for('login'))
-    payments_list = get_all_payment_requests()
-    return render_template('payments.html', payments=payments_list)
+    etag = journal_etag('payments.html')
+    if is_not_modified(etag):
+        return conditional_response(Response(status=304), etag)
+    page = load_payments_page()
+    response = make_response(render_template(
+        'payments.html',
+        payments=page['items'],
+        next_url=page_url('payments', 'after', page['next']),
+        prev_url=page_url('payments', 'before', page['prev']),
+        filters=request.args,
+        export_args={k: v for k, v in request.args.items() if k not in ('after', 'before', 'limit', 'format') and v},
+        statuses=PAYMENT_STATUSES,
+        tutors=get_all_tutors(),
+    ))
+    return conditional_response(response, etag)
+
+def payments_json():
+    if not is_logged_in():
+        return jsonify(error='unauthorized'), 401
+    etag = journal_etag()
+    if is_not_modified(etag):
+        return conditional_response(Response(status=304), etag)
+    page = load_payments_page()
+    response = jsonify(
+        items=page['items'],
+        next=page_url('payments_json', 'after', page['next']),
+        prev=page_url('payments_json', 'before', page['prev']),
+    )
+    return conditional_response(response, etag)
+
+def payments_export():
+    if not is_logged_in():
+        return redirect(url_for('login'))
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify(error='unknown format'), 400
+    # Строки идут клиенту по мере чтения из БД — вся история в памяти не собирается
+    rows = iter_payment_requests(payment_filters())
+    filename = f"payments_{datetime.now():%Y%m%d_%H%M%S}.{fmt}"
+    return Response(
+        stream_with_context(export_lines(rows, fmt)),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
+def reference_upload():
+    """Загрузка справочников (CSV/JSON) из интерфейса администратора: все файлы — одной транзакцией"""
+    if not is_logged_in():
+        return redirect(url_for('login'))
+    if not csrf_valid():
+        logger.warning("Загрузка справочников отклонена: неверный CSRF-токен с %s", request.remote_addr)
+        return redirect(url_for('index', import_error='Форма устарела, обновите страницу и повторите загрузку'))
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files:
+        return redirect(url_for('index', import_error='Файлы не выбраны'))
+    try:
+        parts = [parse_reference(f.read().decode('utf-8-sig'), f.filename) for f in files]
+        counts = bulk_upsert_reference(**merge_reference(parts))
+    except (ValueError, UnicodeDecodeError) as e:
+        logger.warning("Ошибка загрузки справочников: %s", e)
+        return redirect(url_for('index', import_error=str(e)))
+    logger.info("Загружены справочники: %s", counts)
+    imported = f"репетиторов {counts['tutors']}, предметов {counts['subjects']}, строк расписания {counts['schedule']}"
+    return redirect(url_for('index', imported=imported))
+
+# === Журнал оплат: фильтры и постраничная навигация ===
+
+def payment_filters():
+    """Фильтры журнала из параметров запроса: status, student, tutor, date_from, date_to"""
+    filters = {}
+    status = request.args.get('status', '')
+    if status in PAYMENT_STATUSES:
+        filters['status'] = status
+    student = request.args.get('student', '').strip()
+    if student.isdigit():
+        filters['user_id'] = int(student)
+    tutor = request.args.get('tutor', '').strip()
+    if tutor:
+        filters['tutor_id'] = tutor
+    for key in ('date_from', 'date_to'):
+        value = request.args.get(key, '').strip()
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            continue
+        filters[key] = value
+    return filters
+
+def journal_etag(template=None):
+    """ETag журнала без чтения самих платежей.
+
+    Зависит от счётчика изменений БД (storage.get_data_revision — растёт с каждой записью, включая
+    справочники и архив), шаблона страницы и статики, адреса которой в неё вписаны (static_url).
+    Параметры запроса в нём не нужны — ETag относится к URL.
+    Last-Modified не отдаётся: точности в секунду не хватает, чтобы различить две записи подряд.
+    """
+    parts = [get_data_revision()]
+    if template:
+        parts.append(file_fingerprint(os.path.join(current_app.root_path, current_app.template_folder, template)))
+        parts.append(static_fingerprint(current_app.static_folder))
+    return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+def is_not_modified(etag):
+    """Есть ли у клиента актуальная копия"""
+    return request.if_none_match.contains(etag)
+
+def conditional_response(response, etag):
+    """Валидатор кэша; браузер хранит копию, но перед показом переспрашивает сервер"""
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def encode_cursor(cursor):
+    """Курсор (date, id) → строка для URL"""
+    date, payment_id = cursor
+    return f"{payment_id}_{date}"
+
+def decode_cursor(value):
+    """Строка из URL → курсор (date, id) или None"""
+    payment_id, _, date = (value or '').partition('_')
+    if not payment_id.isdigit() or not date:
+        return None
+    return date, int(payment_id)
+
+def load_payments_page():
+    """Страница журнала по параметрам текущего запроса"""
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    return get_payment_requests_page(
+        payment_filters(),
+        after=decode_cursor(request.args.get('after')),
+        before=decode_cursor(request.args.get('before')),
+        limit=limit,
+    )
+
+def page_url(endpoint, direction, cursor):
+    """Ссылка на соседнюю страницу с сохранением фильтров"""
+    if not cursor:
+        return None
+    args = {k: v for k, v in request.args.items() if k not in ('after', 'before') and v}
+    args[direction] = encode_cursor(cursor)
+    return url_for(endpoint, **args)
 
 
 def is_logged_in():
     return session.get('logged_in', False)
 
 if __name__ == '__main__':
+    app = create_app()
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
-    logger.info(f"Приложение запущено на порту {port}")
\ No newline at end of file
+    logger.info("Приложение запущено на порту %s", port)
+    # Для разработки; в контейнере приложение запускается через gunicorn (wsgi.py)
+    app.run(host='0.0.0.0', port=port, debug=os.environ.get('FLASK_DEBUG', '') == '1')
\ No newline at end of file
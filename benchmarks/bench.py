@@ -0,0 +1,328 @@
+"""Бенчмарк горячих путей: функции storage.py и обработчики tutorBot.py.
+
+Создаёт временную БД с синтетическими репетиторами, предметами, расписаниями
+и историей платежей, после чего замеряет задержку (p50/p99) и число SQL-выражений
+на операцию. Обработчики бота вызываются напрямую с заглушкой вместо TeleBot,
+поэтому сеть не нужна.
+
+    python benchmarks/bench.py --payments 100000 --output bench.json
+    python benchmarks/bench.py --payments 10000 --baseline benchmarks/baseline.json
+
+С --baseline сравнивает число запросов на операцию с сохранённым результатом
+и завершается с кодом 1, если оно выросло (а с --max-slowdown — ещё и если p99
+вырос больше чем в заданное число раз).
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+MODULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules')
+sys.path.insert(0, MODULES_DIR)
+
+import storage  # noqa: E402
+
+STUDENT_ID_BASE = 1000
+PARENT_IDS = [1, 2]
+
+
+class QueryCounter:
+    """Считает SQL-выражения во всех соединениях storage (включая поток-писатель)"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, sql):
+        with self._lock:
+            self.count += 1
+
+
+class StubBot:
+    """Заглушка TeleBot: запоминает вызовы и сразу возвращает управление"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=1, text=text)
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.calls += 1
+        return True
+
+    def edit_message_reply_markup(self, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        self.calls += 1
+        return True
+
+
+# === Синтетические данные ===
+
+def seed(args):
+    """Заполняет БД: репетиторы, предметы, дефолтное и индивидуальное расписание, платежи"""
+    rnd = random.Random(args.seed)
+    storage.init_db()
+    conn = storage.get_connection()
+    conn.execute('DELETE FROM schedule')
+    conn.executemany(
+        'INSERT OR REPLACE INTO tutors (tutor_id, name, phone, bank) VALUES (?, ?, ?, ?)',
+        [(f'tutor_{i}', f'Репетитор {i}', '0 (000) 000-00-00', 'Банк') for i in range(args.tutors)]
+    )
+    conn.executemany(
+        'INSERT OR IGNORE INTO subjects (name) VALUES (?)',
+        [(f'Предмет {i}',) for i in range(args.subjects)]
+    )
+    subject_ids = [r[0] for r in conn.execute('SELECT subject_id FROM subjects')]
+    schedule = [(None, sid, f'tutor_{sid % args.tutors}', 1000 + sid) for sid in subject_ids]
+    for student in range(args.students // 2):
+        for sid in rnd.sample(subject_ids, min(5, len(subject_ids))):
+            schedule.append((STUDENT_ID_BASE + student, sid, f'tutor_{rnd.randrange(args.tutors)}', 1500))
+    conn.executemany('INSERT INTO schedule (student_id, subject_id, tutor_id, price) VALUES (?, ?, ?, ?)', schedule)
+
+    start = datetime(2024, 1, 1)
+    span = 2 * 365 * 24 * 3600
+    statuses = ['COMPLETE'] * 8 + ['CANCEL', 'NEW']
+    batch = []
+    for _ in range(args.payments):
+        student = rnd.randrange(args.students)
+        sid = rnd.choice(subject_ids)
+        batch.append((
+            (start + timedelta(seconds=rnd.randrange(span))).strftime('%Y-%m-%d %H:%M:%S'),
+            STUDENT_ID_BASE + student, f'user{student}', f'Ученик {student}',
+            sid, f'tutor_{sid % args.tutors}', 1000 + sid, rnd.choice(statuses),
+        ))
+        if len(batch) >= 10000:
+            _insert_payments(conn, batch)
+            batch = []
+    _insert_payments(conn, batch)
+    conn.commit()
+    storage.rebuild_payment_totals()
+    conn.execute('ANALYZE')
+    storage.invalidate_reference_cache()
+    return subject_ids
+
+
+def _insert_payments(conn, rows):
+    conn.executemany('''
+        INSERT INTO payment_requests (date, user_id, username, first_name, subject_id, tutor_id, price, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+
+def new_payment(student=0, subject_id=1):
+    return storage.add_payment_request({
+        'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'user_id': STUDENT_ID_BASE + student,
+        'username': f'user{student}',
+        'first_name': f'Ученик {student}',
+        'subject_id': subject_id,
+        'tutor_id': 'tutor_0',
+        'price': 1000,
+    })
+
+
+# === Замеры ===
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(name, func, counter, iterations, setup=None):
+    """Выполняет func(*setup()) iterations раз после одного прогревочного вызова; setup не входит в замер"""
+    func(*(setup(-1) if setup else ()))
+    timings, queries = [], 0
+    for i in range(iterations):
+        args = setup(i) if setup else ()
+        before = counter.count
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+        queries += counter.count - before
+    return {
+        'name': name,
+        'iterations': iterations,
+        'p50_ms': round(percentile(timings, 50) * 1000, 4),
+        'p99_ms': round(percentile(timings, 99) * 1000, 4),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 4),
+        # Все SQL-выражения, включая BEGIN/SAVEPOINT/COMMIT потока-писателя
+        'queries_per_op': round(queries / iterations, 2),
+    }
+
+
+def storage_cases(subject_ids):
+    """Сценарии для функций storage.py: (имя, функция, setup)"""
+    student = STUDENT_ID_BASE
+    cold = lambda i: storage.invalidate_reference_cache() or ()  # noqa: E731
+    new_id = lambda i: (new_payment(),)  # noqa: E731
+    return [
+        ('storage.get_tutor[cold]', lambda: storage.get_tutor('tutor_1'), cold),
+        ('storage.get_tutor[cached]', lambda: storage.get_tutor('tutor_1'), None),
+        ('storage.get_resolved_schedule[cold]', lambda: storage.get_resolved_schedule(student), cold),
+        ('storage.get_resolved_schedule[cached]', lambda: storage.get_resolved_schedule(student), None),
+        ('storage.get_schedule_item[cold]', lambda: storage.get_schedule_item(student, subject_ids[0]), cold),
+        ('storage.get_active_payment_requests', storage.get_active_payment_requests, None),
+        ('storage.get_active_payment', storage.get_active_payment, new_id),
+        ('storage.get_payment_requests_page', storage.get_payment_requests_page, None),
+        ('storage.get_payment_requests_page[status]', lambda: storage.get_payment_requests_page({'status': 'COMPLETE'}), None),
+        ('storage.get_payment_totals', lambda: storage.get_payment_totals('student'), None),
+        ('storage.add_payment_request', new_payment, None),
+        ('storage.transition_payment_status', lambda pid: storage.transition_payment_status(pid, 'COMPLETE'), new_id),
+    ]
+
+
+def handler_cases(bot_module, subject_ids):
+    """Сценарии для обработчиков tutorBot.py: (имя, функция, setup)"""
+    student, parent = STUDENT_ID_BASE, PARENT_IDS[0]
+
+    def message(user_id, text):
+        user = SimpleNamespace(id=user_id, first_name='Ученик', username='user', is_bot=False)
+        return SimpleNamespace(chat=SimpleNamespace(id=user_id), from_user=user, text=text, message_id=1)
+
+    def call(user_id, data):
+        user = SimpleNamespace(id=user_id, first_name='Ученик', username='user', is_bot=False)
+        return SimpleNamespace(id=str(user_id), data=data, from_user=user, message=message(user_id, ''))
+
+    def callback(action, user_id=parent):
+        def args(i):
+            payment_id = new_payment()
+            return call(user_id, bot_module.codec.encode(action, payment_id)), payment_id
+        return args
+
+    return [
+        ('handler.send_study', bot_module.send_study, lambda i: (message(student, '/study'),)),
+        ('handler.send_pay', bot_module.send_pay, lambda i: (message(parent, '/pay'),)),
+        ('handler.handle_study_selection', bot_module.handle_study_selection,
+         lambda i: (call(student, bot_module.codec.encode('subject', subject_ids[0])), subject_ids[0])),
+        ('handler.handle_payment_details', bot_module.handle_payment_details, callback('pay')),
+        ('handler.handle_payment_confirm', bot_module.handle_payment_confirm, callback('payConfirm')),
+        ('handler.handle_payment_cancel', bot_module.handle_payment_cancel, callback('payCancel')),
+        ('handler.handle_payment_delay', bot_module.handle_payment_delay, callback('payDelay')),
+    ]
+
+
+def load_bot(stub):
+    """Создаёт бота tutorBot с тестовым окружением и подменяет TeleBot и очередь отправки заглушкой"""
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARK')
+    os.environ['USER_WHITE_LIST'] = ','.join(str(i) for i in PARENT_IDS + [STUDENT_ID_BASE])
+    os.environ['PAY_LIST'] = ','.join(str(i) for i in PARENT_IDS)
+    import tutorBot
+
+    tutorBot.create_bot()
+    for method in ('send_message', 'answer_callback_query', 'edit_message_reply_markup'):
+        setattr(tutorBot.bot, method, getattr(stub, method))
+    tutorBot.outbox = stub
+    logging.getLogger('tutorBot').setLevel(logging.WARNING)
+    return tutorBot
+
+
+# === Сравнение с базовым результатом ===
+
+def compare(results, baseline, max_slowdown):
+    """Список регрессий относительно baseline"""
+    previous = {r['name']: r for r in baseline['results']}
+    measured = {r['name'] for r in results}
+    # Случай из baseline, который не удалось измерить (например, tutorBot не импортируется), — тоже регрессия
+    problems = [f"{name}: не измерен" for name in previous if name not in measured]
+    for r in results:
+        old = previous.get(r['name'])
+        if not old:
+            continue
+        if r['queries_per_op'] > old['queries_per_op']:
+            problems.append(f"{r['name']}: запросов на операцию {old['queries_per_op']} → {r['queries_per_op']}")
+        if max_slowdown and r['p99_ms'] > old['p99_ms'] * max_slowdown:
+            problems.append(f"{r['name']}: p99 {old['p99_ms']} мс → {r['p99_ms']} мс")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк storage.py и обработчиков tutorBot.py')
+    parser.add_argument('--payments', type=int, default=10000, help='Размер истории платежей')
+    parser.add_argument('--students', type=int, default=50)
+    parser.add_argument('--tutors', type=int, default=10)
+    parser.add_argument('--subjects', type=int, default=20)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Файл для JSON с результатами (по умолчанию stdout)')
+    parser.add_argument('--baseline', help='JSON предыдущего прогона для сравнения')
+    parser.add_argument('--max-slowdown', type=float, help='Допустимый рост p99 относительно baseline, во сколько раз')
+    args = parser.parse_args(argv)
+    # Пути из командной строки считаются от текущего каталога, а работаем мы во временном
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    # Все побочные эффекты импорта (database/, ../logs) остаются во временном каталоге
+    workdir = os.path.join(tempfile.mkdtemp(prefix='tutor-bench-'), 'work')
+    os.makedirs(workdir)
+    os.chdir(workdir)
+    storage.DB_PATH = os.path.join(workdir, 'tutor_bot.db')
+
+    counter = QueryCounter()
+    storage.set_trace_callback(counter)
+
+    started = time.perf_counter()
+    subject_ids = seed(args)
+    seed_seconds = time.perf_counter() - started
+
+    results = [measure(name, func, counter, args.iterations, setup)
+               for name, func, setup in storage_cases(subject_ids)]
+
+    stub = StubBot()
+    handlers_note = None
+    try:
+        bot_module = load_bot(stub)
+    except ImportError as e:
+        handlers_note = f'обработчики пропущены: {e}'
+        print(handlers_note, file=sys.stderr)
+    else:
+        results += [measure(name, func, counter, args.iterations, setup)
+                    for name, func, setup in handler_cases(bot_module, subject_ids)]
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'sqlite': storage.sqlite3.sqlite_version,
+        'dataset': {
+            'payments': args.payments,
+            'students': args.students,
+            'tutors': args.tutors,
+            'subjects': args.subjects,
+            'seed_seconds': round(seed_seconds, 2),
+        },
+        'cache': storage.cache_stats(),
+        'note': handlers_note,
+        'results': results,
+    }
+    storage.stop_writer()
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False, indent=2) + '\n')
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    for r in results:
+        print(f"{r['name']:<48} p50 {r['p50_ms']:>9.3f} мс  p99 {r['p99_ms']:>9.3f} мс  "
+              f"запросов {r['queries_per_op']:>6}", file=sys.stderr)
+
+    if baseline:
+        with open(baseline, encoding='utf-8') as f:
+            problems = compare(results, json.load(f), args.max_slowdown)
+        for problem in problems:
+            print(f"РЕГРЕССИЯ: {problem}", file=sys.stderr)
+        if problems:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,450 @@
+"""Нагрузочный прогон бота: обновления Telegram из JSON Lines через настоящие обработчики tutorBot.py.
+
+Обновления (по одному объекту Update в строке) берутся из файла или генерируются для
+N учеников и M родителей и подаются в bot.process_new_updates с заданной частотой —
+так же, как в режиме webhook: через ChatOrderedExecutor, по порядку внутри чата.
+Запросы к Bot API уходят на локальный фейковый сервер, БД — временная.
+
+    python benchmarks/replay.py --students 200 --parents 2 --rounds 5 --rate 100
+    python benchmarks/replay.py --students 50 --rounds 2 --record updates.jsonl
+    python benchmarks/replay.py --updates updates.jsonl --speedup 50 --output replay.json
+
+Отчёт: пропускная способность, задержка от поступления обновления до конца обработки,
+время обработчиков и функций storage (из metrics.py) как показатель конкуренции за БД,
+число вызовов Bot API. Записанные реальные обновления содержат callback_data,
+подписанную ключом бота, — для их воспроизведения нужен тот же CALLBACK_SECRET.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+MODULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules')
+sys.path.insert(0, MODULES_DIR)
+
+import storage  # noqa: E402
+
+STUDENT_ID_BASE = 1000
+PARENT_ID_BASE = 1
+TOKEN = '123456:REPLAY'
+
+
+# === Фейковый Bot API ===
+
+class FakeBotApi:
+    """Локальный HTTP-сервер, отвечающий на методы Bot API как Telegram, с необязательной задержкой"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._message_id = 0
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                api.handle(self)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='fake-bot-api', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def handle(self, request):
+        # telebot передаёт параметры в строке запроса, файлы — в теле
+        path, _, query = request.path.partition('?')
+        method = path.rsplit('/', 1)[-1]
+        length = int(request.headers.get('Content-Length') or 0)
+        params = dict(parse_qsl(query))
+        params.update(_parse_params(request.rfile.read(length), request.headers.get('Content-Type', '')))
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self._message_id += 1
+            message_id = self._message_id
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'sendMessage':
+            chat_id = int(params.get('chat_id', 0))
+            result = {'message_id': message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+                      'chat': {'id': chat_id, 'type': 'private'}}
+        elif method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Replay', 'username': 'replay_bot'}
+        else:
+            result = True
+        body = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def _parse_params(body, content_type):
+    if not body:
+        return {}
+    if 'json' in content_type:
+        return json.loads(body)
+    if 'x-www-form-urlencoded' in content_type:
+        return dict(parse_qsl(body.decode('utf-8')))
+    return {}
+
+
+# === Обновления ===
+
+def _user(user_id, name):
+    return {'id': user_id, 'is_bot': False, 'first_name': name, 'username': f'user{user_id}'}
+
+
+class UpdateFactory:
+    """Генерирует объекты Update в формате Telegram"""
+
+    def __init__(self, codec, started):
+        self.codec = codec
+        self.started = started
+        self._update_id = 0
+
+    def _next(self, offset):
+        self._update_id += 1
+        return self._update_id, int(self.started + offset)
+
+    def message(self, user_id, name, text, offset):
+        update_id, date = self._next(offset)
+        message = {'message_id': update_id, 'date': date, 'chat': {'id': user_id, 'type': 'private'},
+                   'from': _user(user_id, name), 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': update_id, 'message': message}
+
+    def press(self, user_id, name, action, entity_id, offset):
+        update_id, date = self._next(offset)
+        return {'update_id': update_id, 'callback_query': {
+            'id': f'replay-{update_id}', 'chat_instance': str(user_id), 'from': _user(user_id, name),
+            'data': self.codec.encode(action, entity_id),
+            'message': {'message_id': update_id, 'date': date, 'chat': {'id': user_id, 'type': 'private'}, 'text': ''},
+        }}
+
+
+def synthesize(factory, students, parents, rounds, subject_ids, rnd):
+    """Сценарий: ученики выбирают предметы (иногда дважды нажимая кнопку), родители смотрят /pay
+    и оплачивают, откладывают или отклоняют платежи — иногда оба родителя одновременно.
+
+    Каждое выбранное занятие — новый платёж. В разных раундах ученик выбирает разные предметы:
+    одинаковое нажатие подряд бот считает повтором (PRESS_DEDUP_SECONDS) и платёж не создаёт,
+    поэтому раундов не может быть больше, чем предметов.
+    """
+    if rounds > len(subject_ids):
+        raise ValueError(f'Раундов ({rounds}) больше, чем предметов ({len(subject_ids)})')
+    updates = []
+    offset = 0.0
+    payment_id = 0
+    # С какого предмета начинает каждый ученик; дальше — по кругу, по предмету на раунд
+    first_subject = [rnd.randrange(len(subject_ids)) for _ in range(students)]
+    for round_index in range(rounds):
+        created = []
+        for i in range(students):
+            student = STUDENT_ID_BASE + i
+            name = f'Ученик {i}'
+            updates.append(factory.message(student, name, '/study', offset))
+            subject_id = subject_ids[(first_subject[i] + round_index) % len(subject_ids)]
+            updates.append(factory.press(student, name, 'subject', subject_id, offset + 1))
+            if rnd.random() < 0.1:
+                # Двойное нажатие: повтор не должен создать второй платёж
+                updates.append(factory.press(student, name, 'subject', subject_id, offset + 1))
+            payment_id += 1
+            created.append(payment_id)
+            offset += 0.5
+
+        for j in range(parents):
+            updates.append(factory.message(PARENT_ID_BASE + j, f'Родитель {j}', '/pay', offset))
+        for k, pid in enumerate(created):
+            parent = PARENT_ID_BASE + k % parents
+            name = f'Родитель {k % parents}'
+            updates.append(factory.press(parent, name, 'pay', pid, offset))
+            action = rnd.choices(['payConfirm', 'payDelay', 'payCancel'], weights=[0.8, 0.15, 0.05])[0]
+            updates.append(factory.press(parent, name, action, pid, offset + 1))
+            if parents > 1 and rnd.random() < 0.05:
+                # Второй родитель подтверждает тот же платёж — проверка атомарной смены статуса
+                other = PARENT_ID_BASE + (k + 1) % parents
+                updates.append(factory.press(other, 'Родитель', 'payConfirm', pid, offset + 1))
+            offset += 0.5
+    return updates
+
+
+def read_updates(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def user_ids(updates):
+    """Все пользователи из обновлений — чтобы пропустить их через белый список"""
+    ids = set()
+    for update in updates:
+        part = update.get('message') or update.get('callback_query') or {}
+        if 'from' in part:
+            ids.add(part['from']['id'])
+    return ids
+
+
+def schedule(updates, rate, speedup):
+    """Момент подачи каждого обновления в секундах от начала прогона"""
+    if rate:
+        return [i / rate for i in range(len(updates))]
+    if speedup:
+        dates = [(u.get('message') or u.get('callback_query', {}).get('message') or {}).get('date', 0) for u in updates]
+        first = min(dates) if dates else 0
+        return [(d - first) / speedup for d in dates]
+    return [0.0] * len(updates)
+
+
+# === Прогон ===
+
+def replay(bot_module, updates, offsets, workers, queue_size):
+    """Подаёт обновления по расписанию offsets. Возвращает (задержки в секундах, отклонено, секунд на прогон)"""
+    from telebot.types import Update
+    from workers import ChatOrderedExecutor
+
+    latencies = []
+    lock = threading.Lock()
+    executor = ChatOrderedExecutor(workers, queue_size, name='replay-worker')
+
+    def process(update, arrived):
+        try:
+            bot_module.bot.process_new_updates([update])
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - arrived)
+
+    rejected = 0
+    started = time.perf_counter()
+    for raw, offset in zip(updates, offsets):
+        delay = started + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        update = Update.de_json(json.dumps(raw))
+        if not executor.submit(bot_module._update_chat_id(update), process, update, time.perf_counter()):
+            rejected += 1
+    executor.shutdown(wait=True)
+    return latencies, rejected, time.perf_counter() - started
+
+
+def run_readers(count, stop, stats):
+    """Параллельные читатели журнала — как открытый веб-интерфейс"""
+    def read():
+        cursor = None
+        while not stop.is_set():
+            started = time.perf_counter()
+            page = storage.get_payment_requests_page(after=cursor, limit=storage.PAGE_SIZE)
+            elapsed = time.perf_counter() - started
+            cursor = page['next']
+            with stats['lock']:
+                stats['latencies'].append(elapsed)
+        storage.close_connection()
+
+    threads = [threading.Thread(target=read, name=f'reader-{i}', daemon=True) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def seed_reference(subjects, tutors):
+    tutor_rows = [(f'tutor_{i}', f'Репетитор {i}', '0 (000) 000-00-00', 'Банк') for i in range(tutors)]
+    subject_names = [f'Предмет {i}' for i in range(subjects)]
+    schedule_rows = [(None, name, f'tutor_{i % tutors}', 1000 + 100 * i) for i, name in enumerate(subject_names)]
+    storage.bulk_upsert_reference(tutor_rows, subject_names, schedule_rows)
+    rows = storage.get_connection().execute('SELECT subject_id FROM subjects WHERE name LIKE ?', ('Предмет %',))
+    return [r[0] for r in rows]
+
+
+# === Отчёт ===
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def histogram_summary(histograms, name, label, buckets):
+    """Сводка гистограммы metrics.py по значениям метки: число, среднее и оценка p99 по границам корзин"""
+    summary = {}
+    for (series, labels), h in histograms.items():
+        if series != name or not h['count']:
+            continue
+        key = dict(labels).get(label, '')
+        p99 = next((bound for bound, count in zip(buckets, h['buckets']) if count >= 0.99 * h['count']), None)
+        summary[key] = {'count': h['count'], 'mean_ms': _ms(h['sum'] / h['count']), 'p99_ms_le': _ms(p99)}
+    return dict(sorted(summary.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон обработчиков tutorBot.py по журналу обновлений')
+    source = parser.add_argument_group('обновления')
+    source.add_argument('--updates', help='JSON Lines с объектами Update (по умолчанию — сгенерировать)')
+    source.add_argument('--students', type=int, default=50)
+    source.add_argument('--parents', type=int, default=2)
+    source.add_argument('--rounds', type=int, default=3,
+                        help='Сколько раз каждый ученик выбирает предмет (не больше --subjects)')
+    source.add_argument('--subjects', type=int, default=10)
+    source.add_argument('--tutors', type=int, default=5)
+    source.add_argument('--seed', type=int, default=42)
+    source.add_argument('--record', help='Сохранить сгенерированные обновления в JSON Lines и продолжить')
+    pace = parser.add_argument_group('темп')
+    pace.add_argument('--rate', type=float, default=0, help='Обновлений в секунду (0 — без пауз)')
+    pace.add_argument('--speedup', type=float, default=0, help='Ускорение относительно дат в обновлениях')
+    run = parser.add_argument_group('окружение')
+    run.add_argument('--workers', type=int, default=4, help='Потоков обработки (как BOT_WORKERS)')
+    run.add_argument('--queue-size', type=int, default=1000)
+    run.add_argument('--readers', type=int, default=0, help='Параллельных читателей журнала (веб-интерфейс)')
+    run.add_argument('--api-latency-ms', type=float, default=0, help='Задержка ответов фейкового Bot API')
+    run.add_argument('--no-drain', action='store_true',
+                     help='Не ждать отправки очереди сообщений. Очередь ограничена лимитом Telegram '
+                          '(сообщение в секунду на чат), а родители получают по сообщению на платёж: '
+                          'с настройками по умолчанию ожидание занимает 2–3 минуты')
+    run.add_argument('--keep-throttle', action='store_true', help='Не поднимать лимиты USER_RATE/USER_BURST')
+    run.add_argument('--output', help='Файл для JSON-отчёта (по умолчанию stdout)')
+    run.add_argument('--verbose', action='store_true', help='Не приглушать логи бота')
+    args = parser.parse_args(argv)
+    if not args.updates and args.rounds > args.subjects:
+        parser.error('--rounds не может быть больше --subjects: повтор того же нажатия бот не обрабатывает')
+    updates_path = os.path.abspath(args.updates) if args.updates else None
+    record = os.path.abspath(args.record) if args.record else None
+    output = os.path.abspath(args.output) if args.output else None
+
+    # Все побочные эффекты (database/, ../logs) остаются во временном каталоге
+    workdir = os.path.join(tempfile.mkdtemp(prefix='tutor-replay-'), 'work')
+    os.makedirs(workdir)
+    os.chdir(workdir)
+    storage.DB_PATH = os.path.join(workdir, 'tutor_bot.db')
+
+    updates = read_updates(updates_path) if updates_path else None
+    os.environ['TELEGRAM_BOT_TOKEN'] = TOKEN
+    os.environ.setdefault('CALLBACK_SECRET', 'replay')
+    parents = [PARENT_ID_BASE + j for j in range(args.parents)]
+    students = [STUDENT_ID_BASE + i for i in range(args.students)]
+    known = user_ids(updates) if updates is not None else set(parents + students)
+    os.environ['USER_WHITE_LIST'] = ','.join(str(i) for i in sorted(known))
+    if updates is None:
+        os.environ['PAY_LIST'] = ','.join(str(i) for i in parents)
+    if not args.keep_throttle:
+        # Прогон проверяет ёмкость, а не защиту от флуда: один синтетический пользователь шлёт много обновлений
+        os.environ['USER_RATE'] = '1000000'
+        os.environ['USER_BURST'] = '1000000'
+
+    import telebot
+    import metrics
+    import tutorBot
+
+    api = FakeBotApi(args.api_latency_ms / 1000).start()
+    telebot.apihelper.API_URL = f'http://127.0.0.1:{api.port}/bot{{0}}/{{1}}'
+
+    tutorBot.create_bot()
+    # Обновления раздаёт наш пул потоков, как в режиме webhook
+    tutorBot.bot.threaded = False
+    level = logging.INFO if args.verbose else logging.ERROR
+    logging.getLogger('tutorBot').setLevel(level)
+    telebot.logger.setLevel(level)
+
+    subject_ids = seed_reference(args.subjects, args.tutors)
+    if updates is None:
+        factory = UpdateFactory(tutorBot.codec, time.time())
+        updates = synthesize(factory, args.students, args.parents, args.rounds, subject_ids, random.Random(args.seed))
+        if record:
+            with open(record, 'w', encoding='utf-8') as f:
+                for update in updates:
+                    f.write(json.dumps(update, ensure_ascii=False) + '\n')
+
+    stop = threading.Event()
+    reader_stats = {'lock': threading.Lock(), 'latencies': []}
+    readers = run_readers(args.readers, stop, reader_stats)
+
+    latencies, rejected, elapsed = replay(tutorBot, updates, schedule(updates, args.rate, args.speedup),
+                                          args.workers, args.queue_size)
+    stop.set()
+    for thread in readers:
+        thread.join()
+    drain_started = time.perf_counter()
+    tutorBot.outbox.shutdown(wait=not args.no_drain)
+    outbox_drain = None if args.no_drain else round(time.perf_counter() - drain_started, 3)
+    storage.stop_writer()
+    api.stop()
+
+    counters, histograms = metrics.registry.snapshot()
+    buckets = metrics.registry.buckets
+    handler_errors = {dict(labels).get('handler'): value for (name, labels), value in counters.items()
+                      if name == 'tutor_handler_errors_total'}
+    conn = storage.get_connection()
+    statuses = dict(conn.execute('SELECT status, COUNT(*) FROM payment_requests GROUP BY status').fetchall())
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'sqlite': storage.sqlite3.sqlite_version,
+        'source': updates_path or 'synthetic',
+        'settings': {'updates': len(updates), 'rate': args.rate, 'speedup': args.speedup, 'workers': args.workers,
+                     'readers': args.readers, 'api_latency_ms': args.api_latency_ms},
+        'throughput': {
+            'processed': len(latencies),
+            'rejected': rejected,
+            'seconds': round(elapsed, 3),
+            'updates_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'outbox_drain_seconds': outbox_drain,
+        },
+        'latency': {
+            'p50_ms': _ms(percentile(latencies, 0.5)),
+            'p99_ms': _ms(percentile(latencies, 0.99)),
+            'max_ms': _ms(max(latencies) if latencies else None),
+        },
+        'handlers': histogram_summary(histograms, 'tutor_handler_duration_seconds', 'handler', buckets),
+        'handler_errors': handler_errors,
+        # Время функций storage включает ожидание потока-писателя и блокировок SQLite
+        'storage': histogram_summary(histograms, 'tutor_storage_duration_seconds', 'function', buckets),
+        'readers': {
+            'pages': len(reader_stats['latencies']),
+            'p50_ms': _ms(percentile(reader_stats['latencies'], 0.5)),
+            'p99_ms': _ms(percentile(reader_stats['latencies'], 0.99)),
+        },
+        'bot_api_calls': dict(sorted(api.calls.items())),
+        'payments': statuses,
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    t, lat = report['throughput'], report['latency']
+    print(f"обновлений {t['processed']} (отклонено {t['rejected']}) за {t['seconds']} с — "
+          f"{t['updates_per_second']} в секунду; задержка p50 {lat['p50_ms']} мс, p99 {lat['p99_ms']} мс", file=sys.stderr)
+    for name, s in report['storage'].items():
+        print(f"  storage.{name:<36} {s['count']:>7}  среднее {s['mean_ms']:>8} мс  p99 ≤ {s['p99_ms_le']} мс",
+              file=sys.stderr)
+    return 1 if handler_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
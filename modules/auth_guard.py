@@ -0,0 +1,118 @@
+import hmac
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+import pyotp
+
+# Сколько соседних 30-секундных интервалов принимается (расхождение часов)
+TOTP_VALID_WINDOW = 1
+
+# Не больше LOGIN_MAX_FAILURES неудачных попыток за LOGIN_WINDOW_SECONDS с одного IP или из одной сессии
+LOGIN_MAX_FAILURES = 5
+LOGIN_WINDOW_SECONDS = 15 * 60
+
+# Сколько IP и сессий помнить (старые вытесняются)
+LOGIN_MAX_KEYS = 10000
+
+# Только ASCII-цифры: \d пропускает цифры других алфавитов, на которых падает compare_digest
+_CODE_RE = re.compile(r'[0-9]{6}')
+
+
+class TotpVerifier:
+    """Проверка TOTP-кодов администратора.
+
+    Коды текущего окна вычисляются один раз за интервал, дальше проверка — сравнение строк.
+    Каждый код принимается один раз: после успешного входа коды того же и более ранних
+    интервалов отклоняются.
+    """
+
+    def __init__(self, secret, valid_window=TOTP_VALID_WINDOW):
+        self._totp = pyotp.TOTP(secret)
+        self.valid_window = valid_window
+        self._lock = threading.Lock()
+        self._codes_step = None
+        self._codes = ()
+        self._last_used_step = -1
+
+    def now(self):
+        return self._totp.now()
+
+    def verify(self, code):
+        """True, если код верен для текущего окна и ещё не использовался"""
+        if not is_code_format(code):
+            return False
+        step = int(time.time()) // self._totp.interval
+        with self._lock:
+            for code_step, expected in self._window_codes(step):
+                if hmac.compare_digest(code, expected):
+                    if code_step <= self._last_used_step:
+                        return False
+                    self._last_used_step = code_step
+                    return True
+        return False
+
+    def _window_codes(self, step):
+        if self._codes_step != step:
+            self._codes = tuple(
+                (s, self._totp.generate_otp(s))
+                for s in range(step - self.valid_window, step + self.valid_window + 1)
+            )
+            self._codes_step = step
+        return self._codes
+
+
+def is_code_format(code):
+    """Быстрая проверка формата кода (6 цифр) — до любых вычислений"""
+    return isinstance(code, str) and bool(_CODE_RE.fullmatch(code))
+
+
+class LoginLimiter:
+    """Скользящее окно неудачных попыток входа по ключам (IP, сессия) в ограниченной памяти"""
+
+    def __init__(self, max_failures=LOGIN_MAX_FAILURES, window_seconds=LOGIN_WINDOW_SECONDS, max_keys=LOGIN_MAX_KEYS):
+        self.max_failures = max_failures
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._failures = OrderedDict()
+
+    def retry_after(self, *keys):
+        """0, если с этих ключей можно пытаться войти, иначе сколько секунд ждать"""
+        now = time.monotonic()
+        wait = 0
+        with self._lock:
+            for key in keys:
+                failures = self._recent(key, now)
+                if failures is not None and len(failures) >= self.max_failures:
+                    wait = max(wait, failures[0] + self.window_seconds - now)
+        return wait
+
+    def fail(self, *keys):
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                failures = self._recent(key, now)
+                if failures is None:
+                    failures = self._failures[key] = deque(maxlen=self.max_failures)
+                failures.append(now)
+                self._failures.move_to_end(key)
+            while len(self._failures) > self.max_keys:
+                self._failures.popitem(last=False)
+
+    def reset(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._failures.pop(key, None)
+
+    def _recent(self, key, now):
+        failures = self._failures.get(key)
+        if failures is None:
+            return None
+        while failures and failures[0] <= now - self.window_seconds:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return None
+        return failures
@@ -0,0 +1,78 @@
+import base64
+import hashlib
+import hmac
+
+# Версия формата: кнопки, выпущенные со старой версией, отклоняются как устаревшие
+VERSION = '1'
+
+# Telegram ограничивает callback_data 64 байтами
+MAX_CALLBACK_DATA = 64
+
+# Длина подписи в символах base64url (48 бит)
+MAC_LENGTH = 8
+
+# Действие → односимвольный код в callback_data. Коды не переиспользуются: удалённое действие
+# оставляет свой код занятым, иначе старые кнопки попадут в чужой обработчик
+ACTIONS = {
+    'subject': 's',
+    'pay': 'p',
+    'payConfirm': 'c',
+    'payCancel': 'x',
+    'payDelay': 'd',
+}
+_ACTIONS_BY_CODE = {code: action for action, code in ACTIONS.items()}
+
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+class CallbackCodec:
+    """Компактная подписанная callback_data: версия, код действия, id сущности (base36) и HMAC.
+
+    Пример: '1p2n9.Xk3v_a0Q' — действие pay для платежа 3429.
+    decode() проверяет формат и подпись без обращения к БД и возвращает None для чужих,
+    подделанных и устаревших кнопок.
+    """
+
+    def __init__(self, secret):
+        self._key = secret.encode('utf-8') if isinstance(secret, str) else secret
+
+    def encode(self, action, entity_id):
+        payload = f'{VERSION}{ACTIONS[action]}{_base36(entity_id)}'
+        data = f'{payload}.{self._sign(payload)}'
+        if len(data.encode('utf-8')) > MAX_CALLBACK_DATA:
+            raise ValueError(f'callback_data длиннее {MAX_CALLBACK_DATA} байт: {data}')
+        return data
+
+    def decode(self, data):
+        """callback_data → (действие, id) или None"""
+        # Выпущенная нами callback_data всегда ASCII; иное отсекаем до compare_digest и int(), которые на нём падают
+        if not data or not data.isascii():
+            return None
+        payload, _, mac = data.partition('.')
+        if len(payload) < 3 or payload[0] != VERSION or len(mac) != MAC_LENGTH:
+            return None
+        if not hmac.compare_digest(mac, self._sign(payload)):
+            return None
+        action = _ACTIONS_BY_CODE.get(payload[1])
+        try:
+            entity_id = int(payload[2:], 36)
+        except ValueError:
+            return None
+        if action is None:
+            return None
+        return action, entity_id
+
+    def _sign(self, payload):
+        digest = hmac.new(self._key, payload.encode('utf-8'), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode('ascii')[:MAC_LENGTH]
+
+
+def _base36(value):
+    if value < 0:
+        raise ValueError(f'Отрицательный id: {value}')
+    digits = ''
+    while True:
+        value, rest = divmod(value, 36)
+        digits = _DIGITS[rest] + digits
+        if not value:
+            return digits
@@ -0,0 +1,73 @@
+import atexit
+import json
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Ротация файла лога: размер одного файла и сколько старых файлов хранить
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+TEXT_FORMAT_WITH_TRACE = '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись лога — один JSON-объект в строке"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id and trace_id != '-':
+            data['trace_id'] = trace_id
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """QueueHandler, который не форматирует сообщение в вызывающем потоке.
+
+    Стандартный QueueHandler.prepare() собирает строку сообщения ещё до постановки в очередь;
+    здесь запись уходит как есть, и msg % args вычисляется уже в потоке QueueListener.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(name, log_file, filters=(), trace_in_console=False):
+    """Настраивает логгер name: запись в очередь в потоке вызова, вывод — в фоновом потоке.
+
+    Файл log_file ротируется по размеру и содержит JSON-записи, в консоль пишется обычный текст.
+    filters навешиваются на обработчик очереди и выполняются в вызывающем потоке
+    (например, чтобы запомнить trace_id текущего обновления). Повторный вызов ничего не меняет.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    if logger.handlers:
+        return logger
+
+    os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+    file_handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT_WITH_TRACE if trace_in_console else TEXT_FORMAT))
+
+    log_queue = queue.Queue()
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    # При завершении процесса дописываем всё, что осталось в очереди
+    atexit.register(listener.stop)
+
+    queue_handler = _DeferredQueueHandler(log_queue)
+    for log_filter in filters:
+        queue_handler.addFilter(log_filter)
+    logger.addHandler(queue_handler)
+    return logger
@@ -0,0 +1,30 @@
+import argparse
+
+
+def main(argv=None):
+    """Обслуживание базы из командной строки: python modules/maintenance.py archive --older-than-days 180"""
+    parser = argparse.ArgumentParser(description='Обслуживание базы данных')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    archive = commands.add_parser('archive', help='Перенести закрытые платежи в архив')
+    archive.add_argument('--older-than-days', type=int, help='Возраст платежа в днях (по умолчанию ARCHIVE_AFTER_DAYS)')
+    archive.add_argument('--batch-size', type=int, help='Платежей за одну транзакцию')
+    archive.add_argument('--vacuum', action='store_true', help='После переноса сжать файл базы (VACUUM)')
+    args = parser.parse_args(argv)
+
+    import storage
+
+    storage.ensure_db()
+    if args.command == 'archive':
+        moved = storage.archive_settled_payments(
+            args.older_than_days if args.older_than_days is not None else storage.ARCHIVE_AFTER_DAYS,
+            args.batch_size or storage.ARCHIVE_BATCH_SIZE,
+        )
+        print(f'Перенесено в архив: {moved}')
+        if args.vacuum:
+            storage.vacuum()
+            print('Файл базы сжат')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import hmac
+import logging
+import threading
+import time
+import uuid
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы корзин гистограмм задержки, в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Registry:
+    """Счётчики и гистограммы в памяти процесса с выводом в текстовом формате Prometheus"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, text):
+        """Задаёт строку HELP для метрики"""
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def snapshot(self):
+        """Копия текущих значений: ({(имя, метки): значение}, {(имя, метки): {'buckets', 'sum', 'count'}})"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']}
+                          for key, h in self._histograms.items()}
+        return counters, histograms
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        counters, histograms = self.snapshot()
+
+        lines = []
+        for kind, series in (('counter', counters), ('histogram', histograms)):
+            for name in sorted({name for name, _ in series}):
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name != name:
+                        continue
+                    if kind == 'counter':
+                        lines.append(f'{name}{_labels(labels)} {value}')
+                        continue
+                    for bound, count in zip(self.buckets, value['buckets']):
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", repr(float(bound))),))} {count}')
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {value["count"]}')
+                    lines.append(f'{name}_sum{_labels(labels)} {value["sum"]}')
+                    lines.append(f'{name}_count{_labels(labels)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def scrape_allowed(authorization, token):
+    """Есть ли в заголовке Authorization токен сборщика метрик ("Bearer <token>"). Без заданного токена — нет"""
+    if not token or not authorization:
+        return False
+    scheme, _, value = authorization.partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(value.strip().encode('utf-8'), token.encode('utf-8'))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+# Общий реестр процесса
+registry = Registry()
+registry.describe('tutor_handler_duration_seconds', 'Время обработки обновления Telegram обработчиком бота')
+registry.describe('tutor_handler_errors_total', 'Исключения в обработчиках бота')
+registry.describe('tutor_storage_duration_seconds', 'Время выполнения функций storage.py')
+registry.describe('tutor_telegram_api_duration_seconds', 'Время запросов к Telegram Bot API')
+registry.describe('tutor_telegram_api_errors_total', 'Ответы Telegram Bot API с ошибкой')
+registry.describe('tutor_http_request_duration_seconds', 'Время обработки HTTP-запросов веб-интерфейса')
+
+
+# === Трассировка ===
+
+_trace = threading.local()
+
+
+def new_trace_id():
+    """Создаёт идентификатор трассировки для текущего потока и возвращает его"""
+    _trace.id = uuid.uuid4().hex[:12]
+    return _trace.id
+
+
+def current_trace_id():
+    return getattr(_trace, 'id', None) or '-'
+
+
+class TraceIdFilter(logging.Filter):
+    """Добавляет к записям лога поле trace_id текущего обновления"""
+
+    def filter(self, record):
+        record.trace_id = current_trace_id()
+        return True
+
+
+# === Инструментирование ===
+
+def observe_storage(function, seconds):
+    """Наблюдатель для storage.set_query_observer"""
+    registry.observe('tutor_storage_duration_seconds', seconds, function=function)
+
+
+def instrument_handler(func):
+    """Декоратор обработчика бота: новый trace_id на обновление, замер времени и учёт исключений"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        new_trace_id()
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            registry.inc('tutor_handler_errors_total', handler=func.__name__)
+            raise
+        finally:
+            registry.observe('tutor_handler_duration_seconds', time.perf_counter() - started, handler=func.__name__)
+            _trace.id = None
+    return wrapper
+
+
+def instrument_telegram_api(apihelper):
+    """Подключает замер каждого запроса к Bot API через apihelper.CUSTOM_REQUEST_SENDER"""
+    def timed_sender(method, url, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            response = apihelper._get_req_session().request(method, url, **kwargs)
+        except Exception:
+            registry.inc('tutor_telegram_api_errors_total', method=api_method, code='exception')
+            raise
+        finally:
+            registry.observe('tutor_telegram_api_duration_seconds', time.perf_counter() - started, method=api_method)
+        if response.status_code >= 400:
+            registry.inc('tutor_telegram_api_errors_total', method=api_method, code=str(response.status_code))
+        return response
+
+    apihelper.CUSTOM_REQUEST_SENDER = timed_sender
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    """Отдаёт /metrics на отдельном порту в фоновом потоке (для процесса бота в режиме polling)"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
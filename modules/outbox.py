@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+from workers import ChatOrderedExecutor
+
+# Лимиты Telegram Bot API: около 30 сообщений в секунду всего и около 1 в секунду в один чат
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Берёт токен, если он есть. Возвращает 0 при успехе или сколько секунд ждать следующего"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Ждёт, пока не получится взять токен"""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class Outbox:
+    """Очередь исходящих сообщений.
+
+    send_message() возвращает управление сразу, а доставкой занимается пул потоков:
+    сообщения в один чат уходят по порядку, в разные чаты — параллельно, с соблюдением
+    общего и початового лимитов. Ответ 429 повторяется после паузы retry_after.
+    """
+
+    def __init__(self, bot, workers=4, queue_size=1000, max_retries=3, logger=None):
+        self._bot = bot
+        self._max_retries = max_retries
+        self._logger = logger or logging.getLogger(__name__)
+        self._executor = ChatOrderedExecutor(workers, queue_size, name='outbox', logger=self._logger)
+        self._global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        # Чатов немного (белый список), поэтому вёдра по чатам не вытесняются
+        self._chat_buckets = {}
+        self._chat_buckets_lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        """Ставит сообщение в очередь на отправку"""
+        if not self._executor.submit(chat_id, self._deliver, chat_id, text, kwargs):
+            self._logger.error("Очередь исходящих сообщений переполнена, сообщение в чат %s потеряно", chat_id)
+
+    def shutdown(self, wait=True):
+        """Отправляет уже поставленные сообщения и останавливает потоки"""
+        self._executor.shutdown(wait)
+
+    def _chat_bucket(self, chat_id):
+        with self._chat_buckets_lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+            return bucket
+
+    def _deliver(self, chat_id, text, kwargs):
+        for attempt in range(self._max_retries + 1):
+            self._chat_bucket(chat_id).acquire()
+            self._global_bucket.acquire()
+            try:
+                self._bot.send_message(chat_id, text, **kwargs)
+                return
+            except ApiTelegramException as e:
+                if e.error_code == 429 and attempt < self._max_retries:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                    self._logger.warning("Лимит Telegram для чата %s, повтор через %s с", chat_id, retry_after)
+                    time.sleep(retry_after)
+                    continue
+                self._logger.error("Ошибка при отправке сообщения в чат %s: %s", chat_id, e)
+                return
+            except Exception as e:
+                self._logger.error("Ошибка при отправке сообщения в чат %s: %s", chat_id, e)
+                return
@@ -0,0 +1,89 @@
+import argparse
+import csv
+import io
+import json
+import sys
+from datetime import datetime
+
+# Поддерживаемые форматы выгрузки и их MIME-типы
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+PAYMENT_STATUSES = ['NEW', 'COMPLETE', 'CANCEL']
+
+EXPORT_COLUMNS = ['id', 'date', 'user_id', 'username', 'first_name', 'subject', 'tutor_id', 'tutor_name', 'price', 'status']
+
+
+def iter_csv(rows):
+    """Строки CSV (с заголовком) по одной на платёж"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_jsonl(rows):
+    """JSON Lines: один объект платежа на строку"""
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+def export_lines(rows, fmt):
+    """Генератор строк выгрузки в формате fmt ('csv' или 'jsonl')"""
+    if fmt == 'csv':
+        return iter_csv(rows)
+    if fmt == 'jsonl':
+        return iter_jsonl(rows)
+    raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+
+
+def _date(value):
+    """Тип аргумента --date-*: дата в формате YYYY-MM-DD"""
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается дата YYYY-MM-DD, получено {value!r}")
+    return value
+
+
+def main(argv=None):
+    """Выгрузка журнала оплат из командной строки: python modules/payments_export.py --format csv > payments.csv"""
+    parser = argparse.ArgumentParser(description='Выгрузка журнала оплат')
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+    parser.add_argument('--status', choices=PAYMENT_STATUSES)
+    parser.add_argument('--student', type=int, help='ID ученика (Telegram user_id)')
+    parser.add_argument('--tutor', help='ID репетитора')
+    parser.add_argument('--date-from', type=_date, help='YYYY-MM-DD')
+    parser.add_argument('--date-to', type=_date, help='YYYY-MM-DD, включительно')
+    parser.add_argument('--output', help='Файл для записи (по умолчанию stdout)')
+    args = parser.parse_args(argv)
+
+    import storage
+
+    # Выгрузка может быть первым обращением к БД: схема (в том числе архив) ещё не создана
+    storage.ensure_db()
+    filters = {
+        'status': args.status,
+        'user_id': args.student,
+        'tutor_id': args.tutor,
+        'date_from': args.date_from,
+        'date_to': args.date_to,
+    }
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        for line in export_lines(storage.iter_payment_requests(filters), args.format):
+            out.write(line)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import csv
+import io
+import json
+import os
+
+# Тип CSV-файла определяется по набору колонок в заголовке
+CSV_KINDS = {
+    'tutors': ('tutor_id', 'name', 'phone', 'bank'),
+    'schedule': ('student_id', 'subject', 'tutor_id', 'price'),
+    'subjects': ('name',),
+}
+
+
+def empty_reference():
+    return {'tutors': [], 'subjects': [], 'schedule': []}
+
+
+def parse_reference(text, filename):
+    """Разбирает справочники из CSV или JSON (по расширению filename).
+
+    JSON: {"tutors": [{tutor_id, name, phone, bank}], "subjects": ["Название"],
+           "schedule": [{student_id, subject, tutor_id, price}]}.
+    CSV: один справочник на файл, тип определяется по заголовку (см. CSV_KINDS).
+    Пустой student_id в расписании означает расписание по умолчанию.
+    Возвращает {'tutors': [...], 'subjects': [...], 'schedule': [...]} в формате storage.bulk_upsert_reference.
+    """
+    if os.path.splitext(filename)[1].lower() == '.json':
+        data = json.loads(text)
+        if not isinstance(data, dict):
+            raise ValueError(f'{filename}: ожидается JSON-объект с ключами tutors, subjects, schedule')
+        tutors, subjects, schedule = data.get('tutors', []), data.get('subjects', []), data.get('schedule', [])
+    else:
+        reader = csv.DictReader(io.StringIO(text))
+        columns = set(reader.fieldnames or ())
+        kind = next((kind for kind, required in CSV_KINDS.items() if columns >= set(required)), None)
+        if kind is None:
+            raise ValueError(f'{filename}: не удалось определить справочник по колонкам {sorted(columns)}')
+        rows = list(reader)
+        tutors = rows if kind == 'tutors' else []
+        subjects = [row['name'] for row in rows] if kind == 'subjects' else []
+        schedule = rows if kind == 'schedule' else []
+
+    result = empty_reference()
+    try:
+        result['tutors'] = [tuple(_required(t, field) for field in CSV_KINDS['tutors']) for t in tutors]
+        result['subjects'] = [str(name).strip() for name in subjects if name is not None and str(name).strip()]
+        result['schedule'] = [
+            (_student_id(s.get('student_id')), _required(s, 'subject'), _required(s, 'tutor_id'), int(_required(s, 'price')))
+            for s in schedule
+        ]
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'{filename}: некорректная строка справочника ({e})')
+    return result
+
+
+def merge_reference(parts):
+    """Объединяет справочники из нескольких файлов в один набор для загрузки одной транзакцией"""
+    merged = empty_reference()
+    for part in parts:
+        for key in merged:
+            merged[key].extend(part[key])
+    return merged
+
+
+def _required(row, field):
+    """Непустое значение обязательного поля строки справочника"""
+    value = row.get(field)
+    if value is None or str(value).strip() == '':
+        raise ValueError(f'не заполнено поле {field}')
+    return str(value).strip()
+
+
+def _student_id(value):
+    if value is None or str(value).strip() == '':
+        return None
+    return int(value)
+
+
+def main(argv=None):
+    """Загрузка справочников из командной строки: python modules/reference_import.py tutors.csv schedule.csv"""
+    parser = argparse.ArgumentParser(description='Загрузка репетиторов, предметов и расписания')
+    parser.add_argument('files', nargs='+', help='CSV- или JSON-файлы справочников')
+    args = parser.parse_args(argv)
+
+    import storage
+
+    parts = []
+    for path in args.files:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            parts.append(parse_reference(f.read(), path))
+    storage.ensure_db()
+    counts = storage.bulk_upsert_reference(**merge_reference(parts))
+    print(f"Загружено: репетиторов {counts['tutors']}, предметов {counts['subjects']}, строк расписания {counts['schedule']}")
+
+
+if __name__ == '__main__':
+    main()
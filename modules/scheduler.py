@@ -0,0 +1,47 @@
+import logging
+import threading
+import time
+
+
+class Scheduler:
+    """Периодические фоновые задачи в одном потоке.
+
+    Задачи выполняются по очереди; долгая задача сдвигает следующие, но не запускается
+    повторно, пока не закончится предыдущий запуск. Исключения пишутся в лог и не
+    останавливают расписание.
+    """
+
+    def __init__(self, name='scheduler', logger=None):
+        self._logger = logger or logging.getLogger(__name__)
+        self._name = name
+        self._jobs = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def every(self, seconds, func, *args, first_delay=0):
+        """Запускает func(*args) каждые seconds секунд, первый раз — через first_delay"""
+        self._jobs.append({'interval': seconds, 'func': func, 'args': args, 'due': time.monotonic() + first_delay})
+
+    def start(self):
+        if self._thread is None and self._jobs:
+            self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+            self._thread.start()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            job = min(self._jobs, key=lambda j: j['due'])
+            delay = job['due'] - time.monotonic()
+            if delay > 0:
+                # Ждём ближайшую задачу или сигнал остановки
+                self._stop.wait(delay)
+                continue
+            try:
+                job['func'](*job['args'])
+            except Exception as e:
+                self._logger.exception("Ошибка в фоновой задаче %s: %s", job['func'].__name__, e)
+            job['due'] = time.monotonic() + job['interval']
@@ -1,110 +1,661 @@
 import sqlite3
 import os
+import queue
+import threading
+import atexit
+import time
+import heapq
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from functools import wraps
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
-# Путь к базе данных
+# Путь к базе данных (папка создаётся при первом открытии соединения)
 DB_PATH = 'database/tutor_bot.db'
 
-# Создаём папку database, если её нет
-os.makedirs('database', exist_ok=True)
+# Сколько ждать освобождения блокировки другим процессом (бот и веб делят один файл БД)
+BUSY_TIMEOUT_MS = 5000
 
-def init_db():
-    """Создаёт все необходимые таблицы при первом запуске"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
+# Сколько заданий на запись поток-писатель фиксирует одной транзакцией
+WRITE_BATCH_SIZE = 50
 
-        # Таблица репетиторов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tutors (
-                tutor_id TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                phone TEXT NOT NULL,
-                bank TEXT NOT NULL
-            )
-        ''')
+# Сколько ждать, пока поток-писатель возьмёт задание; не взятое за это время задание отменяется
+WRITE_TIMEOUT_SECONDS = 60
 
-        # Таблица предметов (базовая)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS subjects (
-                subject_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE
-            )
-        ''')
+# Размер страницы журнала оплат по умолчанию и максимальный
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
 
-        # Таблица расписания: связь предмет-репетитор-цена (для всех или конкретного студента)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS schedule (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                student_id INTEGER,  -- NULL = для всех студентов (дефолт)
-                subject_id INTEGER NOT NULL,
-                tutor_id TEXT NOT NULL,
-                price INTEGER NOT NULL,
-                FOREIGN KEY (subject_id) REFERENCES subjects (subject_id),
-                FOREIGN KEY (tutor_id) REFERENCES tutors (tutor_id),
-                UNIQUE(student_id, subject_id)
-            )
-        ''')
+# Оплаченные и отменённые платежи старше стольких дней переносятся в архив
+ARCHIVE_AFTER_DAYS = 180
+ARCHIVE_BATCH_SIZE = 5000
 
-        # Таблица платежей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payment_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                username TEXT,
-                first_name TEXT NOT NULL,
-                subject_id INTEGER NOT NULL,
-                tutor_id TEXT NOT NULL,
-                price INTEGER NOT NULL,
-                status TEXT NOT NULL DEFAULT 'NEW',
-                FOREIGN KEY (subject_id) REFERENCES subjects (subject_id),
-                FOREIGN KEY (tutor_id) REFERENCES tutors (tutor_id)
-            )
-        ''')
+# Сколько неоплаченных платежей попадает в одно напоминание
+REMINDER_LIMIT = 50
+
+# Время жизни и размер кэша справочных данных (репетиторы, предметы, расписание)
+CACHE_TTL_SECONDS = 300
+CACHE_MAX_ENTRIES = 1024
+
+# Не чаще раза в столько секунд поток проверяет, не поменял ли справочники другой процесс;
+# между проверками попадание в кэш обходится без обращения к БД
+REFERENCE_CHECK_SECONDS = 1
+
+# === Соединения ===
+
+# Каждый поток держит одно долгоживущее соединение и счётчик вложенности единицы работы
+_local = threading.local()
+
+# Обработчик трассировки SQL (см. set_trace_callback); каждый поток подключает его к своему соединению сам
+_trace_callback = None
+
+# Наблюдатель за временем выполнения функций storage (см. set_query_observer)
+_observer = None
+
+def get_connection():
+    """Возвращает соединение текущего потока, открывая его при первом обращении"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.path != DB_PATH:
+        # Путь к БД поменялся (например, в бенчмарке) — старое соединение больше не годится
+        close_connection()
+        conn = None
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.path = DB_PATH
+        _local.depth = 0
+        _local.trace = _trace_callback
+        _local.data_version = None
+        _local.reference_checked_at = None
+    elif _local.trace is not _trace_callback:
+        # Соединение принадлежит этому потоку — только он и может поменять ему обработчик
+        conn.set_trace_callback(_trace_callback)
+        _local.trace = _trace_callback
+    return conn
+
+def _open_connection():
+    """Открывает новое соединение с настроенными PRAGMA"""
+    os.makedirs(os.path.dirname(DB_PATH) or '.', exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000)
+    # В режиме WAL достаточно NORMAL: фиксация не ждёт fsync, целостность сохраняется
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA cache_size = -8000')
+    if _trace_callback is not None:
+        conn.set_trace_callback(_trace_callback)
+    return conn
+
+def set_trace_callback(callback):
+    """Вызывает callback(sql) для каждого выполняемого SQL-выражения во всех соединениях процесса.
+
+    None отключает трассировку. Используется для подсчёта запросов в бенчмарках.
+    Соединение SQLite можно трогать только из создавшего его потока, поэтому обработчик
+    подключается при следующем get_connection() в каждом потоке, в том числе в потоке-писателе.
+    """
+    global _trace_callback
+    _trace_callback = callback
+
+def close_connection():
+    """Закрывает соединение текущего потока (если оно открыто)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+        _local.depth = 0
+
+@contextmanager
+def unit_of_work(snapshot=False):
+    """Единица работы: все запросы внутри блока идут через одно соединение, записи — в одной транзакции.
+
+    SELECT в sqlite3 транзакцию не открывает: без snapshot каждое чтение видит БД на свой момент.
+    snapshot=True начинает транзакцию сразу (BEGIN), и все чтения блока видят один снимок —
+    нужно, когда блок читает несколько таблиц, между которыми переносятся строки (рабочая и архив).
+
+    Блоки можно вкладывать друг в друга — фиксация (или откат) выполняется
+    только при выходе из самого внешнего блока.
+    """
+    conn = get_connection()
+    if snapshot and _local.depth == 0 and not conn.in_transaction:
+        conn.execute('BEGIN')
+    _local.depth += 1
+    try:
+        yield conn
+    except BaseException:
+        if _local.depth == 1:
+            conn.rollback()
+        raise
+    else:
+        if _local.depth == 1:
+            conn.commit()
+    finally:
+        _local.depth -= 1
+
+def set_query_observer(observer):
+    """Вызывает observer(имя_функции, секунды) после каждого вызова публичной функции storage. None отключает"""
+    global _observer
+    _observer = observer
+
+def _observed(func):
+    """Сообщает наблюдателю время выполнения функции (если наблюдатель задан)"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        observer = _observer
+        if observer is None:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            observer(func.__name__, time.perf_counter() - started)
+    return wrapper
+
+# === Поток-писатель ===
+
+# Все записи в БД процесса идут через один поток: задания копятся в очереди
+# и фиксируются пачками, поэтому писатели не конкурируют за блокировку файла
+_write_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+_STOP = object()
+
+def start_writer():
+    """Запускает поток-писатель, если он ещё не запущен"""
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name='storage-writer', daemon=True)
+            _writer_thread.start()
+
+def stop_writer():
+    """Дожидается выполнения поставленных записей и останавливает поток-писатель"""
+    global _writer_thread
+    with _writer_lock:
+        thread = _writer_thread
+        _writer_thread = None
+    if thread is not None and thread.is_alive():
+        _write_queue.put((_STOP, None, None))
+        thread.join()
+
+atexit.register(stop_writer)
+
+def _run_write(func, *args):
+    """Выполняет func(conn, *args) в потоке-писателе и возвращает её результат"""
+    if threading.current_thread() is _writer_thread:
+        # Уже внутри пачки писателя — выполняем сразу, иначе поток ждал бы сам себя
+        return func(get_connection(), *args)
+    start_writer()
+    future = Future()
+    _write_queue.put((func, args, future))
+    try:
+        return future.result(timeout=WRITE_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        # Не начатое задание отменяется и уже не выполнится; начатое дожидаемся — оно вот-вот закончится
+        if future.cancel():
+            raise TimeoutError(f'Поток-писатель не взял запись за {WRITE_TIMEOUT_SECONDS} с')
+        return future.result()
+
+def _writer_loop():
+    while True:
+        batch = [_write_queue.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        stop = any(func is _STOP for func, _, _ in batch)
+        # Отменённые вызывающим (см. _run_write) задания пропускаются, остальные больше отменить нельзя
+        jobs = [job for job in batch if job[0] is not _STOP and job[2].set_running_or_notify_cancel()]
+        if jobs:
+            _write_batch(jobs)
+        if stop:
+            close_connection()
+            return
 
-        # Заполняем начальные данные, если таблицы пустые
-        cursor.execute("SELECT COUNT(*) FROM tutors")
-        if cursor.fetchone()[0] == 0:
-            tutors_data = [
-                ('tutor_0', 'Репетитор', '0 (000) 000-00-00', 'Банк'),
-            ]
-            cursor.executemany("INSERT INTO tutors (tutor_id, name, phone, bank) VALUES (?, ?, ?, ?)", tutors_data)
-
-        cursor.execute("SELECT COUNT(*) FROM subjects")
-        if cursor.fetchone()[0] == 0:
-            subjects_data = [('Предмет',),]
-            cursor.executemany("INSERT INTO subjects (name) VALUES (?)", subjects_data)
-
-        cursor.execute("SELECT COUNT(*) FROM schedule WHERE student_id IS NULL")
-        if cursor.fetchone()[0] == 0:
-            # Дефолтное расписание
-            default_schedule = [
-                (None, 'Предмет', 'tutor_0', 0),
-            ]
-            for student_id, subject_name, tutor_id, price in default_schedule:
-                cursor.execute("SELECT subject_id FROM subjects WHERE name = ?", (subject_name,))
-                subject_id = cursor.fetchone()[0]
-                cursor.execute(
-                    "INSERT INTO schedule (student_id, subject_id, tutor_id, price) VALUES (?, ?, ?, ?)",
-                    (student_id, subject_id, tutor_id, price)
-                )
+def _write_batch(jobs):
+    """Выполняет пачку заданий в одной транзакции; ошибка задания откатывает только его.
 
+    Любая другая ошибка (в том числе при открытии соединения) завершает все задания пачки
+    этим исключением, а поток-писатель продолжает работу.
+    """
+    conn = None
+    results = []
+    try:
+        conn = get_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        for func, args, future in jobs:
+            conn.execute('SAVEPOINT write_job')
+            try:
+                result = func(conn, *args)
+            except Exception as e:
+                conn.execute('ROLLBACK TO write_job')
+                conn.execute('RELEASE write_job')
+                future.set_exception(e)
+            else:
+                conn.execute('RELEASE write_job')
+                results.append((future, result))
+        if results:
+            # В той же транзакции, что и сами записи: читатель не увидит новые данные со старым счётчиком
+            conn.execute("UPDATE revisions SET value = value + 1 WHERE name = 'data'")
         conn.commit()
+    except Exception as e:
+        if conn is not None and conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                # Соединение в неизвестном состоянии — следующая пачка откроет новое
+                close_connection()
+        for func, args, future in jobs:
+            if not future.done():
+                future.set_exception(e)
+        return
 
-def _insert_schedule_batch(cursor, data):
-    """Вспомогательная функция для вставки расписания"""
-    for student_id, subject_name, tutor_id, price in data:
-        cursor.execute("SELECT subject_id FROM subjects WHERE name = ?", (subject_name,))
-        subject_id = cursor.fetchone()[0]
-        cursor.execute(
-            "INSERT INTO schedule (student_id, subject_id, tutor_id, price) VALUES (?, ?, ?, ?)",
-            (student_id, subject_id, tutor_id, price)
+    for future, result in results:
+        future.set_result(result)
+
+# === Кэш справочных данных ===
+
+_MISSING = object()
+
+class _TTLCache:
+    """LRU-кэш с ограниченным временем жизни записей и счётчиками попаданий/промахов"""
+
+    def __init__(self, name, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Растёт при каждой инвалидации: значение, прочитанное из БД до неё, в кэш уже не попадёт
+        self._generation = 0
+
+    def get(self, key):
+        """Возвращает (значение, поколение); при промахе значение — _MISSING"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0], self._generation
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return _MISSING, self._generation
+
+    def put(self, key, value, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=_MISSING):
+        """Удаляет одну запись или (без аргумента) весь кэш"""
+        with self._lock:
+            self._generation += 1
+            if key is _MISSING:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+_tutor_cache = _TTLCache('tutors')
+_subject_cache = _TTLCache('subjects')
+_schedule_cache = _TTLCache('schedule')
+_CACHES = {cache.name: cache for cache in (_tutor_cache, _subject_cache, _schedule_cache)}
+
+def _cached(cache):
+    """Кэширует результат функции по её аргументам. Возвращаемые значения общие — не изменяйте их"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            key = (func.__name__,) + args
+            value, generation = cache.get(key)
+            if value is not _MISSING and _sync_reference_cache():
+                # Справочники поменял другой процесс — закэшированное значение устарело
+                value, generation = cache.get(key)
+            if value is _MISSING:
+                value = func(*args)
+                cache.put(key, value, generation)
+            return value
+        return wrapper
+    return decorator
+
+def invalidate_reference_cache(*tables):
+    """Сбрасывает кэш для перечисленных таблиц ('tutors', 'subjects', 'schedule'), без аргументов — для всех.
+
+    Вызывается после любой записи в справочные таблицы.
+    """
+    for name in tables or _CACHES:
+        _CACHES[name].invalidate()
+
+# Версия справочников в БД (revisions.reference), под которую заполнен кэш процесса
+_reference_revision = None
+_reference_lock = threading.Lock()
+
+def _sync_reference_cache():
+    """Сбрасывает кэш, если справочники поменял другой процесс (или поток-писатель этого). True, если сбросил.
+
+    Вызывается при попадании в кэш: промах и так читает БД. Поток проверяет не чаще раза
+    в REFERENCE_CHECK_SECONDS, так что чужое изменение видно с задержкой до этого интервала
+    (своё — сразу, см. bulk_upsert_reference). PRAGMA data_version меняется после каждой фиксации
+    чужим соединением и не читает файл, поэтому счётчик revisions перечитывается, только когда
+    в БД что-то записали.
+    """
+    global _reference_revision
+    conn = get_connection()
+    now = time.monotonic()
+    checked_at = _local.reference_checked_at
+    if checked_at is not None and now - checked_at < REFERENCE_CHECK_SECONDS:
+        return False
+    _local.reference_checked_at = now
+    data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+    if data_version == _local.data_version:
+        return False
+    revision = _read_reference_revision(conn)
+    _local.data_version = data_version
+    with _reference_lock:
+        if revision == _reference_revision:
+            return False
+        _reference_revision = revision
+    invalidate_reference_cache()
+    return True
+
+def _read_reference_revision(conn):
+    return conn.execute("SELECT value FROM revisions WHERE name = 'reference'").fetchone()[0]
+
+def cache_stats():
+    """Счётчики попаданий, промахов и размер каждого кэша"""
+    return {name: cache.stats() for name, cache in _CACHES.items()}
+
+# === Схема и миграции ===
+
+# Миграции применяются по порядку; номер последней применённой хранится в PRAGMA user_version.
+# Шаг миграции — SQL-строка или функция, принимающая соединение.
+MIGRATIONS = [
+    (1, [
+        # Таблица репетиторов
+        '''
+        CREATE TABLE IF NOT EXISTS tutors (
+            tutor_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            bank TEXT NOT NULL
         )
+        ''',
+        # Таблица предметов (базовая)
+        '''
+        CREATE TABLE IF NOT EXISTS subjects (
+            subject_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE
+        )
+        ''',
+        # Таблица расписания: связь предмет-репетитор-цена (для всех или конкретного студента).
+        # UNIQUE(student_id, subject_id) заодно служит индексом для поиска по student_id
+        '''
+        CREATE TABLE IF NOT EXISTS schedule (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id INTEGER,  -- NULL = для всех студентов (дефолт)
+            subject_id INTEGER NOT NULL,
+            tutor_id TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            FOREIGN KEY (subject_id) REFERENCES subjects (subject_id),
+            FOREIGN KEY (tutor_id) REFERENCES tutors (tutor_id),
+            UNIQUE(student_id, subject_id)
+        )
+        ''',
+        # Таблица платежей
+        '''
+        CREATE TABLE IF NOT EXISTS payment_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            first_name TEXT NOT NULL,
+            subject_id INTEGER NOT NULL,
+            tutor_id TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'NEW',
+            FOREIGN KEY (subject_id) REFERENCES subjects (subject_id),
+            FOREIGN KEY (tutor_id) REFERENCES tutors (tutor_id)
+        )
+        ''',
+    ]),
+    (2, [
+        # Активные платежи: WHERE status = 'NEW' ORDER BY date
+        'CREATE INDEX IF NOT EXISTS idx_payment_requests_status_date ON payment_requests (status, date)',
+        # Платежи конкретного ученика в нужном статусе
+        'CREATE INDEX IF NOT EXISTS idx_payment_requests_user_status ON payment_requests (user_id, status)',
+        # Журнал оплат: ORDER BY date DESC
+        'CREATE INDEX IF NOT EXISTS idx_payment_requests_date ON payment_requests (date)',
+    ]),
+    (3, [
+        # Итоги по платежам, которые обновляются при каждой записи, а не считаются GROUP BY по всей истории.
+        # scope: 'student' (key = user_id), 'tutor' (key = tutor_id), 'month' (key = YYYY-MM)
+        '''
+        CREATE TABLE IF NOT EXISTS payment_totals (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            status TEXT NOT NULL,
+            label TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            amount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, key, status)
+        )
+        ''',
+        # Однократно заполняем итоги по уже накопленной истории (архива на этой версии схемы ещё нет)
+        lambda conn: _fill_payment_totals(conn, ('payment_requests',)),
+    ]),
+    (4, [
+        # Архив закрытых платежей: в рабочей таблице остаются только свежие и неоплаченные.
+        # id совпадает с исходным платежом, поэтому ссылки и курсоры журнала не меняются
+        '''
+        CREATE TABLE IF NOT EXISTS payment_requests_archive (
+            id INTEGER PRIMARY KEY,
+            date TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            first_name TEXT NOT NULL,
+            subject_id INTEGER NOT NULL,
+            tutor_id TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_payment_requests_archive_status_date ON payment_requests_archive (status, date)',
+        'CREATE INDEX IF NOT EXISTS idx_payment_requests_archive_user_status ON payment_requests_archive (user_id, status)',
+        'CREATE INDEX IF NOT EXISTS idx_payment_requests_archive_date ON payment_requests_archive (date)',
+    ]),
+    (5, [
+        # До какого момента не напоминать о неоплаченном платеже (NULL — можно напоминать сразу).
+        # Поиск напоминаний идёт по idx_payment_requests_status_date, отложенные отсеиваются в тех же строках
+        'ALTER TABLE payment_requests ADD COLUMN snooze_until TEXT',
+    ]),
+    (6, [
+        # Счётчики изменений, общие для всех процессов. reference растёт при каждой загрузке справочников:
+        # бот и веб-процессы сравнивают его с прочитанным раньше и сбрасывают кэш (см. _sync_reference_cache).
+        # data растёт с каждой пачкой записей любого процесса (платежи, справочники, архив):
+        # по нему веб-интерфейс строит ETag журнала, не читая сам журнал
+        '''
+        CREATE TABLE IF NOT EXISTS revisions (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        ''',
+        "INSERT OR IGNORE INTO revisions (name, value) VALUES ('reference', 0)",
+        "INSERT OR IGNORE INTO revisions (name, value) VALUES ('data', 0)",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def migrate(conn):
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает итоговую версию схемы.
+
+    Бот и веб-процессы могут обновлять один файл одновременно, поэтому версия перечитывается
+    под блокировкой записи: миграцию, уже применённую другим процессом, повторять нельзя
+    (ALTER TABLE ... ADD COLUMN не идемпотентен).
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for target, steps in MIGRATIONS:
+        if target <= version:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if target <= version:
+                conn.commit()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f'PRAGMA user_version = {target}')
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        version = target
+    return version
+
+# Путь к БД, для которой в этом процессе уже выполнен init_db (см. ensure_db)
+_ready_path = None
+_ready_lock = threading.Lock()
+
+def ensure_db():
+    """Готовит БД при первом обращении из процесса; повторные вызовы ничего не стоят"""
+    global _ready_path
+    if _ready_path == DB_PATH:
+        return
+    with _ready_lock:
+        if _ready_path != DB_PATH:
+            init_db()
+
+def init_db():
+    """Приводит схему к актуальной версии и заполняет начальные данные при первом запуске.
+
+    Если PRAGMA user_version уже равна SCHEMA_VERSION, миграции и проверка начальных данных пропускаются.
+    """
+    global _ready_path, _reference_revision
+    conn = get_connection()
+    if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+        _create_db(conn)
+    with _reference_lock:
+        _reference_revision = _read_reference_revision(conn)
+    invalidate_reference_cache()
+    start_writer()
+    _ready_path = DB_PATH
+
+def _create_db(conn):
+    # WAL: читатели (веб-интерфейс) не блокируют писателя (бота) и наоборот; режим сохраняется в файле БД
+    conn.execute('PRAGMA journal_mode = WAL')
+    migrate(conn)
+
+    # Проверка и заполнение — под блокировкой записи, иначе два процесса вставят одно и то же
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        _seed(conn)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+def _seed(conn):
+    cursor = conn.cursor()
+
+    # Заполняем начальные данные, если таблицы пустые
+    cursor.execute("SELECT COUNT(*) FROM tutors")
+    if cursor.fetchone()[0] == 0:
+        tutors_data = [
+            ('tutor_0', 'Репетитор', '0 (000) 000-00-00', 'Банк'),
+        ]
+        cursor.executemany("INSERT INTO tutors (tutor_id, name, phone, bank) VALUES (?, ?, ?, ?)", tutors_data)
+
+    cursor.execute("SELECT COUNT(*) FROM subjects")
+    if cursor.fetchone()[0] == 0:
+        subjects_data = [('Предмет',),]
+        cursor.executemany("INSERT INTO subjects (name) VALUES (?)", subjects_data)
+
+    cursor.execute("SELECT COUNT(*) FROM schedule WHERE student_id IS NULL")
+    if cursor.fetchone()[0] == 0:
+        # Дефолтное расписание
+        default_schedule = [
+            (None, 'Предмет', 'tutor_0', 0),
+        ]
+        _upsert_reference(conn, schedule=default_schedule)
+
+# === Загрузка справочников ===
+
+@_observed
+def bulk_upsert_reference(tutors=(), subjects=(), schedule=()):
+    """Загружает справочники одной транзакцией: добавляет новые записи и обновляет существующие.
+
+    tutors — кортежи (tutor_id, name, phone, bank), subjects — названия предметов,
+    schedule — кортежи (student_id или None, название предмета, tutor_id, price).
+    Предметы и репетиторы расписания ищутся среди уже загруженных и переданных в том же вызове;
+    при неизвестном имени вызывается ValueError и ничего не записывается.
+    Возвращает число обработанных записей по таблицам.
+    """
+    result = _run_write(_upsert_reference, list(tutors), list(subjects), list(schedule))
+    invalidate_reference_cache()
+    return result
+
+def _upsert_reference(conn, tutors=(), subjects=(), schedule=()):
+    cursor = conn.cursor()
+    # Кэши других процессов сбросятся при следующем обращении
+    cursor.execute("UPDATE revisions SET value = value + 1 WHERE name = 'reference'")
+    cursor.executemany('''
+        INSERT INTO tutors (tutor_id, name, phone, bank) VALUES (?, ?, ?, ?)
+        ON CONFLICT(tutor_id) DO UPDATE SET name = excluded.name, phone = excluded.phone, bank = excluded.bank
+    ''', tutors)
+    cursor.executemany('INSERT OR IGNORE INTO subjects (name) VALUES (?)', [(name,) for name in subjects])
+    if not schedule:
+        return {'tutors': len(tutors), 'subjects': len(subjects), 'schedule': 0}
+
+    # Имена разрешаются по справочникам, прочитанным один раз, а не запросом на строку
+    subject_ids = dict(cursor.execute('SELECT name, subject_id FROM subjects').fetchall())
+    tutor_ids = {row[0] for row in cursor.execute('SELECT tutor_id FROM tutors')}
+    unknown_subjects = sorted({row[1] for row in schedule} - subject_ids.keys())
+    unknown_tutors = sorted({row[2] for row in schedule} - tutor_ids)
+    if unknown_subjects or unknown_tutors:
+        raise ValueError(f'Неизвестные предметы: {unknown_subjects}, репетиторы: {unknown_tutors}')
+
+    rows = [(student_id, subject_ids[subject], tutor_id, price) for student_id, subject, tutor_id, price in schedule]
+    personal = [row for row in rows if row[0] is not None]
+    default = [row[1:] for row in rows if row[0] is None]
+    cursor.executemany('''
+        INSERT INTO schedule (student_id, subject_id, tutor_id, price) VALUES (?, ?, ?, ?)
+        ON CONFLICT(student_id, subject_id) DO UPDATE SET tutor_id = excluded.tutor_id, price = excluded.price
+    ''', personal)
+    # UNIQUE не срабатывает на NULL, поэтому строки по умолчанию (student_id IS NULL) обновляются отдельно
+    cursor.executemany('''
+        UPDATE schedule SET tutor_id = ?2, price = ?3 WHERE student_id IS NULL AND subject_id = ?1
+    ''', default)
+    cursor.executemany('''
+        INSERT INTO schedule (student_id, subject_id, tutor_id, price)
+        SELECT NULL, ?1, ?2, ?3
+        WHERE NOT EXISTS (SELECT 1 FROM schedule WHERE student_id IS NULL AND subject_id = ?1)
+    ''', default)
+    return {'tutors': len(tutors), 'subjects': len(subjects), 'schedule': len(rows)}
 
 # === Запросы к БД ===
 
+@_observed
+@_cached(_tutor_cache)
 def get_tutor(tutor_id):
     """Получает репетитора по ID"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with unit_of_work() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT tutor_id, name, phone, bank FROM tutors WHERE tutor_id = ?", (tutor_id,))
         row = cursor.fetchone()
@@ -113,9 +664,11 @@ def get_tutor(tutor_id):
             return dict(zip(cols, row))
         return {'tutor_id': 'tutor_default', 'name': 'не указан', 'phone': 'не указан', 'bank': 'не указан'}
 
+@_observed
+@_cached(_subject_cache)
 def get_subject(subject_id):
     """Получает предмет по ID"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with unit_of_work() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT subject_id, name FROM subjects WHERE subject_id = ?", (subject_id,))
         row = cursor.fetchone()
@@ -124,56 +677,71 @@ def get_subject(subject_id):
             return dict(zip(cols, row))
         return None
 
-def get_schedule_for_student(student_id):
-    """Получает расписание студента: предмет, репетитор, цена"""
-    with sqlite3.connect(DB_PATH) as conn:
+# Расписание с подставленными названием предмета и репетитором
+_RESOLVED_SCHEDULE_SQL = '''
+    SELECT s.subject_id, sub.name, s.tutor_id,
+           COALESCE(tu.name, 'не указан'), COALESCE(tu.bank, 'не указан'), s.price
+    FROM schedule s
+    JOIN subjects sub ON s.subject_id = sub.subject_id
+    LEFT JOIN tutors tu ON tu.tutor_id = s.tutor_id
+'''
+_RESOLVED_SCHEDULE_COLUMNS = ['subject_id', 'name', 'tutor_id', 'tutor_name', 'tutor_bank', 'price']
+
+@_observed
+@_cached(_schedule_cache)
+def get_resolved_schedule(student_id):
+    """Расписание студента одним запросом: индивидуальное или, если его нет, дефолтное — вместе с репетитором"""
+    with unit_of_work() as conn:
         cursor = conn.cursor()
-        # Сначала индивидуальные предметы
-        cursor.execute('''
-            SELECT s.subject_id, sub.name, s.tutor_id, s.price
-            FROM schedule s
-            JOIN subjects sub ON s.subject_id = sub.subject_id
-            WHERE s.student_id = ?
+        cursor.execute(_RESOLVED_SCHEDULE_SQL + '''
+            WHERE s.student_id = :student_id
+               OR (s.student_id IS NULL
+                   AND NOT EXISTS (SELECT 1 FROM schedule WHERE student_id = :student_id))
             ORDER BY sub.name
-        ''', (student_id,))
-        rows = cursor.fetchall()
-        if rows:
-            return [dict(zip(['subject_id', 'name', 'tutor_id', 'price'], r)) for r in rows]
+        ''', {'student_id': student_id})
+        return [dict(zip(_RESOLVED_SCHEDULE_COLUMNS, r)) for r in cursor.fetchall()]
 
-        # Или дефолтное
-        cursor.execute('''
-            SELECT s.subject_id, sub.name, s.tutor_id, s.price
-            FROM schedule s
-            JOIN subjects sub ON s.subject_id = sub.subject_id
-            WHERE s.student_id IS NULL
-            ORDER BY sub.name
-        ''')
-        rows = cursor.fetchall()
-        return [dict(zip(['subject_id', 'name', 'tutor_id', 'price'], r)) for r in rows]
+@_observed
+@_cached(_schedule_cache)
+def get_schedule_item(student_id, subject_id):
+    """Предмет из расписания студента (индивидуальная запись важнее дефолтной) с репетитором или None"""
+    with unit_of_work() as conn:
+        cursor = conn.cursor()
+        cursor.execute(_RESOLVED_SCHEDULE_SQL + '''
+            WHERE s.subject_id = ? AND (s.student_id = ? OR s.student_id IS NULL)
+            ORDER BY s.student_id IS NULL
+            LIMIT 1
+        ''', (subject_id, student_id))
+        row = cursor.fetchone()
+        return dict(zip(_RESOLVED_SCHEDULE_COLUMNS, row)) if row else None
 
+@_observed
 def add_payment_request(payment_event):
     """Добавляет новый запрос на оплату"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO payment_requests 
-            (date, user_id, username, first_name, subject_id, tutor_id, price, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?, 'NEW')
-        ''', (
-            payment_event['date'],
-            payment_event['user_id'],
-            payment_event['username'],
-            payment_event['first_name'],
-            payment_event['subject_id'],
-            payment_event['tutor_id'],
-            payment_event['price']
-        ))
-        conn.commit()
-        return cursor.lastrowid
+    return _run_write(_add_payment_request, payment_event)
+
+def _add_payment_request(conn, payment_event):
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO payment_requests 
+        (date, user_id, username, first_name, subject_id, tutor_id, price, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 'NEW')
+    ''', (
+        payment_event['date'],
+        payment_event['user_id'],
+        payment_event['username'],
+        payment_event['first_name'],
+        payment_event['subject_id'],
+        payment_event['tutor_id'],
+        payment_event['price'],
+    ))
+    _bump_totals(conn, payment_event, 'NEW', 1)
+    return cursor.lastrowid
 
+@_observed
 def get_active_payment_requests():
     """Возвращает активные платежи (со статусом 'NEW')"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with unit_of_work() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT pr.id, pr.date, pr.user_id, pr.username, pr.first_name, 
@@ -187,38 +755,398 @@ def get_active_payment_requests():
         columns = ['id', 'date', 'user_id', 'username', 'first_name', 'subject', 'tutor_id', 'price', 'status']
         return [dict(zip(columns, row)) for row in rows]
 
-def get_all_payment_requests():
-    """Возвращает все платежи (все статусы)"""
-    with sqlite3.connect(DB_PATH) as conn:
+@_observed
+def get_due_reminders(created_before, now, limit=REMINDER_LIMIT):
+    """Неоплаченные платежи, созданные раньше created_before и не отложенные позже now (самые старые первыми).
+
+    Даты — строки 'YYYY-MM-DD HH:MM:SS' в том же формате, что и payment_requests.date.
+    """
+    with unit_of_work() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT pr.id, pr.date, pr.user_id, pr.username, pr.first_name, sub.name as subject, tu.name, pr.price, pr.status
+            SELECT pr.id, pr.date, pr.user_id, pr.username, pr.first_name,
+                   sub.name as subject, pr.tutor_id, pr.price, pr.status
             FROM payment_requests pr
             JOIN subjects sub ON pr.subject_id = sub.subject_id
-            JOIN tutors tu ON tu.tutor_id = pr.tutor_id
-            ORDER BY pr.date DESC
+            WHERE pr.status = 'NEW' AND pr.date < ? AND (pr.snooze_until IS NULL OR pr.snooze_until <= ?)
+            ORDER BY pr.date
+            LIMIT ?
+        ''', (created_before, now, limit))
+        rows = cursor.fetchall()
+        columns = ['id', 'date', 'user_id', 'username', 'first_name', 'subject', 'tutor_id', 'price', 'status']
+        return [dict(zip(columns, row)) for row in rows]
+
+@_observed
+def snooze_payments(payment_ids, until):
+    """Откладывает напоминания о неоплаченных платежах до until. Возвращает число изменённых платежей"""
+    payment_ids = list(payment_ids)
+    if not payment_ids:
+        return 0
+    return _run_write(_snooze_payments, payment_ids, until)
+
+def _snooze_payments(conn, payment_ids, until):
+    placeholders = ','.join('?' * len(payment_ids))
+    cursor = conn.execute(
+        f"UPDATE payment_requests SET snooze_until = ? WHERE status = 'NEW' AND id IN ({placeholders})",
+        [until] + payment_ids
+    )
+    return cursor.rowcount
+
+# Платёж вместе с предметом и репетитором — всё, что нужно обработчикам кнопок оплаты
+_PAYMENT_DETAILS_SQL = '''
+    SELECT pr.id, pr.date, pr.user_id, pr.username, pr.first_name,
+           pr.subject_id, sub.name, pr.tutor_id,
+           COALESCE(tu.name, 'не указан'), COALESCE(tu.bank, 'не указан'),
+           pr.price, pr.status
+    FROM payment_requests pr
+    JOIN subjects sub ON pr.subject_id = sub.subject_id
+    LEFT JOIN tutors tu ON tu.tutor_id = pr.tutor_id
+    WHERE pr.id = ?
+'''
+_PAYMENT_DETAILS_COLUMNS = ['id', 'date', 'user_id', 'username', 'first_name', 'subject_id', 'subject',
+                            'tutor_id', 'tutor_name', 'tutor_bank', 'price', 'status']
+
+@_observed
+def get_active_payment(payment_id):
+    """Возвращает активный платёж (статус 'NEW') с предметом и репетитором или None"""
+    with unit_of_work() as conn:
+        cursor = conn.cursor()
+        cursor.execute(_PAYMENT_DETAILS_SQL + " AND pr.status = 'NEW'", (payment_id,))
+        row = cursor.fetchone()
+        return dict(zip(_PAYMENT_DETAILS_COLUMNS, row)) if row else None
+
+@_observed
+def transition_payment_status(payment_id, status, expected_status='NEW'):
+    """Атомарно переводит платёж из expected_status в status.
+
+    Возвращает обновлённый платёж с предметом и репетитором или None,
+    если платёж не найден или уже обработан (например, вторым родителем).
+    """
+    return _run_write(_transition_payment_status, payment_id, status, expected_status)
+
+def _transition_payment_status(conn, payment_id, status, expected_status):
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE payment_requests SET status = ?
+        WHERE id = ? AND status = ?
+    """, (status, payment_id, expected_status))
+    if cursor.rowcount == 0:
+        return None
+    cursor.execute(_PAYMENT_DETAILS_SQL, (payment_id,))
+    payment = dict(zip(_PAYMENT_DETAILS_COLUMNS, cursor.fetchone()))
+    _bump_totals(conn, payment, expected_status, -1)
+    _bump_totals(conn, payment, status, 1)
+    return payment
+
+@_observed
+def get_all_payment_requests():
+    """Возвращает все платежи (все статусы), включая архивные"""
+    with unit_of_work() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            {_journal_sql('payment_requests')}
+            UNION ALL
+            {_journal_sql('payment_requests_archive')}
+            ORDER BY 2 DESC
         ''')
         rows = cursor.fetchall()
-        columns = ['id', 'date', 'user_id', 'username', 'first_name', 'subject', 'tutor_name', 'price', 'status']
+        columns = ['id', 'date', 'user_id', 'username', 'first_name', 'subject', 'tutor_id', 'tutor_name', 'price', 'status']
         return [dict(zip(columns, row)) for row in rows]
 
+@_observed
+def get_data_revision():
+    """Счётчик изменений БД: растёт с каждой зафиксированной пачкой записей любого процесса.
+
+    Меняется при добавлении платежа, смене статуса, загрузке справочников и переносе в архив; не убывает.
+    """
+    with unit_of_work() as conn:
+        return conn.execute("SELECT value FROM revisions WHERE name = 'data'").fetchone()[0]
+
+# Журнал оплат читается из двух таблиц: рабочей и архива
+_JOURNAL_TABLES = ('payment_requests', 'payment_requests_archive')
+
+def _journal_sql(table):
+    """Строка журнала оплат из table: платёж с названиями предмета и репетитора"""
+    return f'''
+        SELECT pr.id, pr.date, pr.user_id, pr.username, pr.first_name, sub.name, pr.tutor_id, tu.name, pr.price, pr.status
+        FROM {table} pr
+        JOIN subjects sub ON pr.subject_id = sub.subject_id
+        JOIN tutors tu ON tu.tutor_id = pr.tutor_id
+    '''
+
+def _journal_tables(filters):
+    """Таблицы, в которых могут быть строки под фильтр: неоплаченных платежей в архиве нет"""
+    if filters and filters.get('status') == 'NEW':
+        return _JOURNAL_TABLES[:1]
+    return _JOURNAL_TABLES
+_JOURNAL_COLUMNS = ['id', 'date', 'user_id', 'username', 'first_name', 'subject', 'tutor_id', 'tutor_name', 'price', 'status']
+
+def _journal_filters(filters):
+    """Условия WHERE по фильтрам журнала: status, user_id, tutor_id, date_from, date_to (даты YYYY-MM-DD включительно)"""
+    filters = filters or {}
+    clauses, params = [], []
+    if filters.get('status'):
+        clauses.append('pr.status = ?')
+        params.append(filters['status'])
+    if filters.get('user_id'):
+        clauses.append('pr.user_id = ?')
+        params.append(filters['user_id'])
+    if filters.get('tutor_id'):
+        clauses.append('pr.tutor_id = ?')
+        params.append(filters['tutor_id'])
+    if filters.get('date_from'):
+        clauses.append('pr.date >= ?')
+        params.append(filters['date_from'])
+    if filters.get('date_to'):
+        clauses.append("pr.date < date(?, '+1 day')")
+        params.append(filters['date_to'])
+    return clauses, params
+
+@_observed
+def get_payment_requests_page(filters=None, after=None, before=None, limit=PAGE_SIZE):
+    """Страница журнала оплат (новые сверху) с постраничной навигацией по ключу (date, id).
+
+    after — курсор (date, id) последней строки предыдущей страницы, before — первой строки следующей.
+    Стоимость запроса зависит только от размера страницы, а не от длины истории.
+    Возвращает {'items': [...], 'next': курсор или None, 'prev': курсор или None}.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    clauses, params = _journal_filters(filters)
+    if before:
+        clauses.append('(pr.date, pr.id) > (?, ?)')
+        params.extend(before)
+        order = 'ASC'
+    else:
+        if after:
+            clauses.append('(pr.date, pr.id) < (?, ?)')
+            params.extend(after)
+        order = 'DESC'
+    where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+
+    # Каждая таблица отдаёт свою страницу по индексу, затем страницы сливаются:
+    # ORDER BY ... LIMIT поверх UNION ALL заставил бы SQLite сортировать всю историю
+    rows = []
+    tables = _journal_tables(filters)
+    # Один снимок на обе таблицы: перенос в архив между запросами не задвоит и не потеряет строку
+    with unit_of_work(snapshot=len(tables) > 1) as conn:
+        cursor = conn.cursor()
+        for table in tables:
+            cursor.execute(
+                f'{_journal_sql(table)} {where} ORDER BY pr.date {order}, pr.id {order} LIMIT ?',
+                params + [limit + 1]
+            )
+            rows.extend(cursor.fetchall())
+    rows.sort(key=lambda r: (r[1], r[0]), reverse=(order == 'DESC'))
+
+    has_more = len(rows) > limit
+    items = [dict(zip(_JOURNAL_COLUMNS, row)) for row in rows[:limit]]
+    if before:
+        items.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = bool(after), has_more
+
+    return {
+        'items': items,
+        'next': (items[-1]['date'], items[-1]['id']) if items and has_older else None,
+        'prev': (items[0]['date'], items[0]['id']) if items and has_newer else None,
+    }
+
+def iter_payment_requests(filters=None, batch_size=500):
+    """Построчно отдаёт журнал оплат (старые сверху) — для выгрузки всей истории за постоянную память.
+
+    Читает отдельным соединением порциями по batch_size строк, чтобы долгое чтение
+    не мешало единице работы текущего потока.
+    """
+    clauses, params = _journal_filters(filters)
+    where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    conn = _open_connection()
+    try:
+        # Обе таблицы читаются в одном снимке, как и в get_payment_requests_page
+        conn.execute('BEGIN')
+        # По упорядоченному курсору на таблицу, слияние — без сортировки в памяти
+        streams = []
+        for table in _journal_tables(filters):
+            cursor = conn.cursor()
+            cursor.execute(f'{_journal_sql(table)} {where} ORDER BY pr.date, pr.id', params)
+            streams.append(_fetch_batches(cursor, batch_size))
+        for row in heapq.merge(*streams, key=lambda r: (r[1], r[0])):
+            yield dict(zip(_JOURNAL_COLUMNS, row))
+    finally:
+        conn.close()
+
+def _fetch_batches(cursor, batch_size):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+@_observed
+@_cached(_tutor_cache)
+def get_all_tutors():
+    """Все репетиторы (для фильтров журнала)"""
+    with unit_of_work() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT tutor_id, name, phone, bank FROM tutors ORDER BY name")
+        return [dict(zip(['tutor_id', 'name', 'phone', 'bank'], r)) for r in cursor.fetchall()]
+
+@_observed
 def update_payment_status(payment_id, status):
     """Обновляет статус платежа"""
-    with sqlite3.connect(DB_PATH) as conn:
+    return _run_write(_update_payment_status, payment_id, status)
+
+def _update_payment_status(conn, payment_id, status):
+    cursor = conn.cursor()
+    cursor.execute('SELECT date, user_id, first_name, tutor_id, price, status FROM payment_requests WHERE id = ?',
+                   (payment_id,))
+    row = cursor.fetchone()
+    if not row:
+        return False
+    payment = dict(zip(['date', 'user_id', 'first_name', 'tutor_id', 'price', 'status'], row))
+    cursor.execute("UPDATE payment_requests SET status = ? WHERE id = ?", (status, payment_id))
+    if payment['status'] != status:
+        _bump_totals(conn, payment, payment['status'], -1)
+        _bump_totals(conn, payment, status, 1)
+    return True
+
+# === Итоги по платежам ===
+
+def _bump_totals(conn, payment, status, sign):
+    """Добавляет (sign=1) или вычитает (sign=-1) платёж из итогов по ученику, репетитору и месяцу"""
+    month = payment['date'][:7]
+    count, amount = sign, sign * payment['price']
+    conn.executemany('''
+        INSERT INTO payment_totals (scope, key, status, label, count, amount)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (scope, key, status) DO UPDATE SET
+            label = excluded.label,
+            count = count + excluded.count,
+            amount = amount + excluded.amount
+    ''', [
+        ('student', str(payment['user_id']), status, payment['first_name'], count, amount),
+        ('tutor', payment['tutor_id'], status, payment['tutor_id'], count, amount),
+        ('month', month, status, month, count, amount),
+    ])
+
+def _fill_payment_totals(conn, tables=_JOURNAL_TABLES):
+    """Пересчитывает итоги по всей истории платежей в tables (GROUP BY) — только для миграции и восстановления.
+
+    Архивные платежи входят в итоги так же, как и рабочие: перенос в архив итогов не меняет.
+    """
+    history = ' UNION ALL '.join(f'SELECT user_id, first_name, tutor_id, price, status, date FROM {table}'
+                                 for table in tables)
+    conn.execute('DELETE FROM payment_totals')
+    conn.execute(f'''
+        INSERT INTO payment_totals (scope, key, status, label, count, amount)
+        SELECT 'student', CAST(user_id AS TEXT), status, MAX(first_name), COUNT(*), SUM(price)
+        FROM ({history}) GROUP BY user_id, status
+    ''')
+    conn.execute(f'''
+        INSERT INTO payment_totals (scope, key, status, label, count, amount)
+        SELECT 'tutor', tutor_id, status, tutor_id, COUNT(*), SUM(price)
+        FROM ({history}) GROUP BY tutor_id, status
+    ''')
+    conn.execute(f'''
+        INSERT INTO payment_totals (scope, key, status, label, count, amount)
+        SELECT 'month', substr(date, 1, 7), status, substr(date, 1, 7), COUNT(*), SUM(price)
+        FROM ({history}) GROUP BY substr(date, 1, 7), status
+    ''')
+
+@_observed
+def rebuild_payment_totals():
+    """Полностью пересчитывает payment_totals (после ручной правки или массовой загрузки платежей)"""
+    return _run_write(_fill_payment_totals)
+
+@_observed
+def get_payment_totals(scope):
+    """Итоги по ученикам ('student'), репетиторам ('tutor') или месяцам ('month', новые сверху).
+
+    Читает только готовые суммы — стоимость зависит от числа групп, а не платежей.
+    Возвращает [{'key', 'label', 'NEW': {'count', 'amount'}, 'COMPLETE': {...}, 'CANCEL': {...}}, ...].
+    """
+    order = 't.key DESC' if scope == 'month' else 'label'
+    with unit_of_work() as conn:
         cursor = conn.cursor()
-        cursor.execute('UPDATE payment_requests SET status = ? WHERE id = ?', (status, payment_id))
-        conn.commit()
-        return cursor.rowcount > 0
+        cursor.execute(f'''
+            SELECT t.key, COALESCE(tu.name, t.label) AS label, t.status, t.count, t.amount
+            FROM payment_totals t
+            LEFT JOIN tutors tu ON t.scope = 'tutor' AND tu.tutor_id = t.key
+            WHERE t.scope = ?
+            ORDER BY {order}
+        ''', (scope,))
+        rows = cursor.fetchall()
+
+    groups = OrderedDict()
+    for key, label, status, count, amount in rows:
+        group = groups.setdefault(key, {
+            'key': key,
+            'label': label,
+            'NEW': {'count': 0, 'amount': 0},
+            'COMPLETE': {'count': 0, 'amount': 0},
+            'CANCEL': {'count': 0, 'amount': 0},
+        })
+        group[status] = {'count': count, 'amount': amount}
+    return list(groups.values())
 
+@_observed
 def get_payment_by_id(payment_id):
-    if payment_id:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM payment_requests WHERE id = ?', (payment_id,))
+    """Платёж по ID (из рабочей таблицы или архива) или None"""
+    if not payment_id:
+        return None
+    cols = ['id', 'date', 'user_id', 'username', 'first_name', 'subject_id', 'tutor_id', 'price', 'status']
+    with unit_of_work(snapshot=True) as conn:
+        cursor = conn.cursor()
+        for table in _JOURNAL_TABLES:
+            cursor.execute(f'SELECT {", ".join(cols)} FROM {table} WHERE id = ?', (payment_id,))
             row = cursor.fetchone()
             if row:
-                cols = ['id', 'date', 'user_id', 'username', 'first_name', 'subject_id', 'tutor_id', 'price', 'status']
                 return dict(zip(cols, row))
-            return None
-    else:
-        return None
\ No newline at end of file
+        return None
+
+# === Архив ===
+
+@_observed
+def archive_settled_payments(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Переносит оплаченные и отменённые платежи старше older_than_days дней в payment_requests_archive.
+
+    Работает порциями по batch_size строк, чтобы не задерживать надолго остальные записи.
+    Итоги (payment_totals) не меняются. Возвращает число перенесённых платежей.
+    """
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).strftime('%Y-%m-%d %H:%M:%S')
+    total = 0
+    while True:
+        moved = _run_write(_archive_batch, cutoff, batch_size)
+        total += moved
+        if moved < batch_size:
+            return total
+
+def _archive_batch(conn, cutoff, batch_size):
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id FROM payment_requests
+        WHERE status IN ('COMPLETE', 'CANCEL') AND date < ?
+        ORDER BY date
+        LIMIT ?
+    ''', (cutoff, batch_size))
+    ids = [r[0] for r in cursor.fetchall()]
+    if not ids:
+        return 0
+    placeholders = ','.join('?' * len(ids))
+    cursor.execute(f'''
+        INSERT OR REPLACE INTO payment_requests_archive
+            (id, date, user_id, username, first_name, subject_id, tutor_id, price, status, archived_at)
+        SELECT id, date, user_id, username, first_name, subject_id, tutor_id, price, status, datetime('now', 'localtime')
+        FROM payment_requests WHERE id IN ({placeholders})
+    ''', ids)
+    cursor.execute(f'DELETE FROM payment_requests WHERE id IN ({placeholders})', ids)
+    return len(ids)
+
+def vacuum():
+    """Сжимает файл базы после переноса в архив. VACUUM не работает внутри транзакции,
+    поэтому выполняется на отдельном соединении, а не через поток записи"""
+    conn = _open_connection()
+    try:
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
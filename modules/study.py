@@ -1,21 +1,18 @@
-from storage import get_schedule_for_student, get_tutor
+from storage import get_resolved_schedule
 
 
-def get_tutor_info(tutor_id):
-    """Возвращает информацию о репетиторе по ID."""
-    return get_tutor(tutor_id)
-
 def command_list_of_study(student_id):
     """Возвращает сообщение и список кнопок с предметами."""
-    schedule = get_schedule_for_student(student_id)
+    # Репетитор уже подставлен в расписание — отдельный запрос на каждую строку не нужен
+    schedule = get_resolved_schedule(student_id)
     message = "выбери предмет из списка"
 
     buttons = []
     for item in schedule:
-        tutor = get_tutor_info(item['tutor_id'])
         buttons.append({
-            'text': f"{item['name']} ({tutor['name']})",
-            'callback_data': f"subject_{item['subject_id']}"
+            'text': f"{item['name']} ({item['tutor_name']})",
+            'action': 'subject',
+            'id': item['subject_id'],
         })
 
     return message, buttons
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
+
+from outbox import TokenBucket
+
+# Лимит на пользователя: USER_RATE обновлений в секунду, не больше USER_BURST подряд
+USER_RATE = 1
+USER_BURST = 5
+
+# Сколько секунд повторное нажатие той же кнопки считается дублем
+DEDUP_SECONDS = 10
+
+# Сколько пользователей и нажатий помнить (старые вытесняются)
+MAX_ENTRIES = 10000
+
+# Первое нажатие ещё обрабатывается, ответа пока нет
+_PENDING = object()
+
+
+class Throttle:
+    """Ограничение частоты обновлений от пользователя и подавление повторных нажатий кнопок.
+
+    Нажатие запоминается по id callback-запроса (повторная доставка того же обновления)
+    и по паре (пользователь, callback_data) — callback_data однозначно задаёт действие и id.
+    Повторное нажатие в течение dedup_seconds получает ответ первого, обработчик не вызывается.
+    """
+
+    def __init__(self, rate=USER_RATE, burst=USER_BURST, dedup_seconds=DEDUP_SECONDS, max_entries=MAX_ENTRIES):
+        self.rate = rate
+        self.burst = burst
+        self.dedup_seconds = dedup_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self._presses = OrderedDict()
+
+    def allow(self, user_id):
+        """Есть ли у пользователя токен на обработку ещё одного обновления"""
+        with self._lock:
+            bucket = self._buckets.pop(user_id, None) or TokenBucket(self.rate, self.burst)
+            self._buckets[user_id] = bucket
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        return not bucket.try_acquire()
+
+    def begin(self, call):
+        """Регистрирует нажатие. Возвращает (дубль ли это, закэшированный ответ или _PENDING)"""
+        now = time.monotonic()
+        keys = _keys(call)
+        with self._lock:
+            for key in keys:
+                entry = self._presses.get(key)
+                if entry is not None and entry[0] > now:
+                    return True, entry[1]
+            for key in keys:
+                self._presses.pop(key, None)
+                self._presses[key] = (now + self.dedup_seconds, _PENDING)
+            while len(self._presses) > self.max_entries:
+                self._presses.popitem(last=False)
+        return False, None
+
+    def remember_answer(self, call, text):
+        """Запоминает ответ на нажатие, чтобы отдать его повторным нажатиям"""
+        with self._lock:
+            for key in _keys(call):
+                entry = self._presses.get(key)
+                if entry is not None:
+                    self._presses[key] = (entry[0], text)
+
+    def finish(self, call, failed=False):
+        """Нажатие обработано. Если обработчик упал, нажатие забывается — повтор сработает"""
+        with self._lock:
+            for key in _keys(call):
+                entry = self._presses.get(key)
+                if entry is None:
+                    continue
+                if failed:
+                    del self._presses[key]
+                elif entry[1] is _PENDING:
+                    # Обработчик не отвечал на нажатие — повтору достаточно пустого ответа
+                    self._presses[key] = (entry[0], None)
+
+
+def _keys(call):
+    return ('query', call.id), ('press', call.from_user.id, call.data)
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    """Middleware telebot: Throttle перед всеми обработчиками сообщений и нажатий кнопок.
+
+    Требует TeleBot(use_class_middlewares=True). Отклонённые обновления не доходят до обработчиков,
+    на дубли нажатий отвечается закэшированным answer_callback_query без обращения к БД.
+    """
+
+    def __init__(self, bot, throttle, logger=None):
+        super().__init__()
+        self.update_sensitive = True
+        self.update_types = ['message', 'callback_query']
+        self._bot = bot
+        self._throttle = throttle
+        self._logger = logger or logging.getLogger(__name__)
+
+    def pre_process_message(self, message, data):
+        if not self._throttle.allow(message.from_user.id):
+            self._logger.warning("Пользователь %s превысил лимит сообщений, сообщение пропущено", message.from_user.id)
+            return CancelUpdate()
+
+    def post_process_message(self, message, data, exception):
+        pass
+
+    def pre_process_callback_query(self, call, data):
+        duplicate, answer = self._throttle.begin(call)
+        if duplicate:
+            self._logger.info("Повторное нажатие кнопки пользователем %s: %s", call.from_user.id, call.data)
+            self._answer(call, "⏳ Уже обрабатывается" if answer is _PENDING else answer)
+            return CancelUpdate()
+        if not self._throttle.allow(call.from_user.id):
+            self._logger.warning("Пользователь %s превысил лимит нажатий", call.from_user.id)
+            self._throttle.finish(call, failed=True)
+            self._answer(call, "Слишком часто. Подождите несколько секунд.")
+            return CancelUpdate()
+
+    def post_process_callback_query(self, call, data, exception):
+        self._throttle.finish(call, failed=exception is not None)
+
+    def _answer(self, call, text):
+        try:
+            self._bot.answer_callback_query(call.id, text=text)
+        except Exception as e:
+            # Запрос мог уже устареть или получить ответ при первом нажатии
+            self._logger.debug("Не удалось ответить на повторное нажатие: %s", e)
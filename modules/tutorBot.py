@@ -1,91 +1,215 @@
+import logging
 import os
 import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-import logging
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Update
+from urllib.parse import urlparse
+import hashlib
+import hmac
 from dotenv import load_dotenv
 import study
-from datetime import datetime
-from storage import init_db, add_payment_request, get_active_payment_requests, update_payment_status, get_subject, get_tutor, get_schedule_for_student, get_payment_by_id
+from datetime import datetime, timedelta
+from workers import ChatOrderedExecutor
+from outbox import Outbox
+from scheduler import Scheduler
+from callback_codec import CallbackCodec
+from throttle import Throttle, ThrottleMiddleware
+import metrics
+from metrics import instrument_handler, TraceIdFilter
+from logging_setup import setup_logging
+from storage import set_query_observer, ensure_db, add_payment_request, get_active_payment_requests, get_active_payment, transition_payment_status, get_subject, get_schedule_item, get_payment_totals, archive_settled_payments, get_due_reminders, snooze_payments
+
+logger = logging.getLogger('tutorBot')
 
-# Загружаем переменные из .env
-load_dotenv()
+# Сколько последних месяцев показывать в /pay summary
+SUMMARY_MONTHS = 3
 
-# Создаём папку logs, если её нет
+# Логи пишутся в отдельном потоке: обработчики не ждут диска
 LOG_DIR = '../logs'
-os.makedirs(LOG_DIR, exist_ok=True)
 LOG_FILE = os.path.join(LOG_DIR, 'tutorBot.log')
 
-# Настройка логирования
-logger = logging.getLogger('tutorBot')
-logger.setLevel(logging.INFO)
-
-# Проверяем, есть ли уже обработчики
-if not logger.handlers:
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    file_handler = logging.FileHandler(LOG_FILE, encoding='utf-8', mode='a')
-    file_handler.setFormatter(formatter)
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-
-# Токен бота
-TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
-if not TOKEN:
-    raise ValueError("Не задана переменная окружения TELEGRAM_BOT_TOKEN")
-
-bot = telebot.TeleBot(TOKEN)
-
-# Инициализация базы данных при запуске
-init_db()
-
-# Получаем белый список пользователей из .env
-USER_WHITE_LIST_STR = os.environ.get("USER_WHITE_LIST", "")
-USER_WHITE_LIST = []
-if USER_WHITE_LIST_STR:
-    try:
-        USER_WHITE_LIST = [int(uid.strip()) for uid in USER_WHITE_LIST_STR.split(",") if uid.strip().isdigit()]
-        logger.info(f"Белый список пользователей: {USER_WHITE_LIST}")
-    except ValueError:
-        logger.error("Некорректные данные в USER_WHITE_LIST. Должны быть числа, разделённые запятыми.")
-
-PAY_LIST_STR = os.environ.get("PAY_LIST", "")
-PAY_LIST = []
-if PAY_LIST_STR:
-    try:
-        PAY_LIST = [int(uid.strip()) for uid in PAY_LIST_STR.split(",") if uid.strip().isdigit()]
-        logger.info(f"Список родителей: {PAY_LIST}")
-    except ValueError:
-        logger.error("Некорректные данные в PAY_LIST. Должны быть числа, разделённые запятыми.")
-
-# Обработчик доступа по белому списку ДОЛЖЕН быть первым в обработчиках!
-@bot.message_handler(func=lambda message: message.chat.id not in USER_WHITE_LIST)
+# Остальные настройки читаются из окружения (и .env) в configure(), объекты создаются в create_bot():
+# импорт модуля не трогает ни окружение, ни файловую систему, ни БД
+TOKEN = None
+BOT_MODE = 'polling'
+WEBHOOK_URL = ''
+WEBHOOK_SECRET = ''
+WEBHOOK_PORT = 8443
+WEBHOOK_THREADS = 4
+BOT_WORKERS = 4
+BOT_QUEUE_SIZE = 100
+USE_WEBHOOK = False
+METRICS_PORT = 0
+METRICS_TOKEN = ''
+OUTBOX_WORKERS = 4
+ARCHIVE_AFTER_DAYS = 0
+ARCHIVE_INTERVAL_HOURS = 24
+REMIND_AFTER_HOURS = 24
+REMIND_EVERY_HOURS = 24
+REMIND_CHECK_MINUTES = 15
+USER_RATE = 1
+USER_BURST = 5
+PRESS_DEDUP_SECONDS = 10
+USER_WHITE_LIST = frozenset()
+PAY_LIST = frozenset()
+
+bot = None
+outbox = None
+scheduler = None
+codec = None
+throttle = None
+
+def configure(setup_logs=True):
+    """Читает настройки из окружения и .env и (если setup_logs) настраивает логирование"""
+    global TOKEN, BOT_MODE, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_PORT, WEBHOOK_THREADS, BOT_WORKERS, BOT_QUEUE_SIZE, USE_WEBHOOK
+    global METRICS_PORT, METRICS_TOKEN, OUTBOX_WORKERS, ARCHIVE_AFTER_DAYS, ARCHIVE_INTERVAL_HOURS, USER_WHITE_LIST, PAY_LIST
+    global REMIND_AFTER_HOURS, REMIND_EVERY_HOURS, REMIND_CHECK_MINUTES, USER_RATE, USER_BURST, PRESS_DEDUP_SECONDS
+
+    # Загружаем переменные из .env
+    load_dotenv()
+
+    # LOG_TRACE_ID=1 добавляет в консольный лог идентификатор обрабатываемого обновления (в JSON-файле он есть всегда)
+    LOG_TRACE_ID = os.environ.get("LOG_TRACE_ID", "") == "1"
+    if setup_logs:
+        setup_logging('tutorBot', LOG_FILE, filters=[TraceIdFilter()], trace_in_console=LOG_TRACE_ID)
+
+    # Токен бота
+    TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
+    if not TOKEN:
+        raise ValueError("Не задана переменная окружения TELEGRAM_BOT_TOKEN")
+
+    # Режим получения обновлений: polling (по умолчанию) или webhook.
+    # Для webhook нужны публичный HTTPS-адрес WEBHOOK_URL и WEBHOOK_SECRET, которым Telegram подписывает запросы;
+    # без любого из них бот откатывается на polling
+    BOT_MODE = os.environ.get("BOT_MODE", "polling")
+    WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+    WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+    WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+    # Потоки HTTP-сервера webhook только принимают обновления и ставят их в очередь BOT_WORKERS
+    WEBHOOK_THREADS = int(os.environ.get("WEBHOOK_THREADS", 4))
+    BOT_WORKERS = int(os.environ.get("BOT_WORKERS", 4))
+    BOT_QUEUE_SIZE = int(os.environ.get("BOT_QUEUE_SIZE", 100))
+    USE_WEBHOOK = BOT_MODE == 'webhook' and bool(WEBHOOK_URL) and bool(WEBHOOK_SECRET)
+
+    # Метрики: в режиме webhook отдаются на /metrics того же сервера, в режиме polling — на METRICS_PORT (если задан)
+    METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+    # Порт webhook открыт наружу, поэтому /metrics там отдаётся только с "Authorization: Bearer METRICS_TOKEN"
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+    # Уведомления другим пользователям (родителям, ученику) отправляются асинхронно
+    OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", 4))
+
+    # Архивация закрытых платежей: ARCHIVE_AFTER_DAYS — возраст в днях, пусто — не архивировать.
+    # Запускается раз в ARCHIVE_INTERVAL_HOURS часов в фоне, вручную — python modules/maintenance.py archive
+    ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", 0))
+    ARCHIVE_INTERVAL_HOURS = float(os.environ.get("ARCHIVE_INTERVAL_HOURS", 24))
+
+    # Напоминания родителям о неоплаченных занятиях старше REMIND_AFTER_HOURS часов (0 — не напоминать):
+    # проверка раз в REMIND_CHECK_MINUTES минут, повтор — не чаще раза в REMIND_EVERY_HOURS часов.
+    # На столько же откладывает платёж кнопка «Оплатить позже»
+    REMIND_AFTER_HOURS = float(os.environ.get("REMIND_AFTER_HOURS", 24))
+    REMIND_EVERY_HOURS = float(os.environ.get("REMIND_EVERY_HOURS", 24))
+    REMIND_CHECK_MINUTES = float(os.environ.get("REMIND_CHECK_MINUTES", 15))
+
+    # Не больше USER_RATE обновлений в секунду от пользователя (USER_BURST подряд);
+    # повторное нажатие той же кнопки в течение PRESS_DEDUP_SECONDS получает прежний ответ
+    USER_RATE = float(os.environ.get("USER_RATE", 1))
+    USER_BURST = int(os.environ.get("USER_BURST", 5))
+    PRESS_DEDUP_SECONDS = float(os.environ.get("PRESS_DEDUP_SECONDS", 10))
+
+    # Белый список пользователей и список родителей; проверка «in» в каждом обработчике — по множеству
+    USER_WHITE_LIST = parse_id_list("USER_WHITE_LIST")
+    logger.info("Белый список пользователей: %s", sorted(USER_WHITE_LIST))
+    PAY_LIST = parse_id_list("PAY_LIST")
+    logger.info("Список родителей: %s", sorted(PAY_LIST))
+
+def parse_id_list(name):
+    """Список Telegram ID через запятую из переменной окружения name → frozenset"""
+    ids = set()
+    for uid in os.environ.get(name, "").split(","):
+        uid = uid.strip()
+        if uid.isdigit():
+            ids.add(int(uid))
+        elif uid:
+            logger.error("Некорректное значение в %s: %r. Должны быть числа, разделённые запятыми.", name, uid)
+    return frozenset(ids)
+
+def create_bot():
+    """Создаёт бота: настройки, логирование, очередь отправки, фоновые задачи, БД и обработчики"""
+    global bot, outbox, scheduler, codec, throttle
+    configure()
+
+    # Ключ подписи кнопок: CALLBACK_SECRET или производный от токена (тогда смена токена делает старые кнопки недействительными)
+    codec = CallbackCodec(os.environ.get("CALLBACK_SECRET") or hashlib.sha256(f"callback:{TOKEN}".encode()).hexdigest())
+
+    # В режиме webhook обработчики выполняет наш пул потоков, поэтому собственный пул telebot не нужен
+    bot = telebot.TeleBot(TOKEN, threaded=not USE_WEBHOOK, use_class_middlewares=True)
+
+    # Лимит частоты и подавление двойных нажатий — до любого обработчика и обращения к БД
+    throttle = Throttle(USER_RATE, USER_BURST, PRESS_DEDUP_SECONDS)
+    bot.setup_middleware(ThrottleMiddleware(bot, throttle, logger))
+
+    # Метрики: время обработчиков, функций storage и запросов к Bot API
+    set_query_observer(metrics.observe_storage)
+    metrics.instrument_telegram_api(telebot.apihelper)
+
+    outbox = Outbox(bot, workers=OUTBOX_WORKERS, logger=logger)
+
+    scheduler = Scheduler(name='bot-scheduler', logger=logger)
+    if ARCHIVE_AFTER_DAYS:
+        scheduler.every(ARCHIVE_INTERVAL_HOURS * 3600, archive_payments, first_delay=60)
+    if REMIND_AFTER_HOURS and PAY_LIST:
+        scheduler.every(REMIND_CHECK_MINUTES * 60, send_payment_reminders, first_delay=30)
+
+    # Схема проверяется по PRAGMA user_version: если она актуальна, миграции и начальные данные пропускаются
+    ensure_db()
+
+    register_handlers(bot)
+    return bot
+
+def register_handlers(bot):
+    # Доступ по белому списку
+    bot.register_message_handler(access_msg, func=lambda message: message.chat.id not in USER_WHITE_LIST)
+    bot.register_message_handler(send_welcome, commands=['start', 'help'])
+    bot.register_message_handler(send_study, commands=['study'])
+    bot.register_message_handler(send_pay, commands=['pay'])
+    bot.register_message_handler(handle_text, content_types=['text'])
+    # Все нажатия кнопок проходят через route_callback и таблицу CALLBACK_HANDLERS
+    bot.register_callback_query_handler(route_callback, func=lambda call: True)
+
+# Доступ по белому списку
+@instrument_handler
 def access_msg(message):
-    logger.info(f"Пользователь {message.from_user.id} отправил команду: {message.text}")
+    logger.info("Пользователь %s отправил команду: %s", message.from_user.id, message.text)
     bot.send_message(message.chat.id, '❌ Доступ ограничен. Обратитесь к администратору бота.')
 
 # Обработчик команд /start и /help
-@bot.message_handler(commands=['start', 'help'])
+@instrument_handler
 def send_welcome(message):
-    logger.info(f"Пользователь {message.from_user.id} отправил команду: {message.text}")
+    logger.info("Пользователь %s отправил команду: %s", message.from_user.id, message.text)
     bot.send_message(message.chat.id, "Привет! Я помогаю тебе с оплатой услуг репетиторов.")
 
-@bot.message_handler(commands=['study'])
+@instrument_handler
 def send_study(message):
-    logger.info(f"Пользователь {message.from_user.id} отправил команду: {message.text}")
+    logger.info("Пользователь %s отправил команду: %s", message.from_user.id, message.text)
     msg_text, buttons = study.command_list_of_study(message.from_user.id)
     reply_message = message.from_user.first_name + ", " + msg_text
     markup = create_inline_keyboard(buttons)
     bot.send_message(message.chat.id, reply_message, reply_markup=markup)
 
-@bot.message_handler(commands=['pay'])
+@instrument_handler
 def send_pay(message):
     if message.from_user.id not in PAY_LIST:
-        logger.warning(f"Пользователю {message.from_user.id} запрещен доступ к команде /pay")
+        logger.warning("Пользователю %s запрещен доступ к команде /pay", message.from_user.id)
         bot.send_message(message.chat.id, '❌ Доступ к этой команде ограничен.')
         return
 
-    logger.info(f"Пользователь {message.from_user.id} запросил список платежей")
+    # /pay summary — сводка вместо списка неоплаченных занятий
+    if message.text.split()[1:2] == ['summary']:
+        logger.info("Пользователь %s запросил сводку по платежам", message.from_user.id)
+        bot.send_message(message.chat.id, format_payment_summary(), parse_mode='Markdown')
+        return
+
+    logger.info("Пользователь %s запросил список платежей", message.from_user.id)
 
     payment_requests = get_active_payment_requests()
     if not payment_requests:
@@ -101,24 +225,53 @@ def send_pay(message):
     buttons = []
     for req in payment_requests:
         text = f"Оплатить: {req['subject']} ({req['first_name']})"
-        callback_data = f"pay_{req['id']}"
-        buttons.append({'text': text, 'callback_data': callback_data})
+        buttons.append({'text': text, 'action': 'pay', 'id': req['id']})
 
     markup = create_inline_keyboard(buttons)
     bot.send_message(message.chat.id, "Выберите, что хотите оплатить", reply_markup=markup)
 
-@bot.message_handler(content_types=['text'])
+def format_payment_summary():
+    """Текст сводки для /pay summary: по ученикам и за последние месяцы"""
+    lines = ["📊 *Сводка по платежам*", "", "*По ученикам:*"]
+    for t in get_payment_totals('student'):
+        lines.append(f"• {t['label']}: к оплате {t['NEW']['amount']} ₽ ({t['NEW']['count']}), "
+                     f"оплачено {t['COMPLETE']['amount']} ₽ ({t['COMPLETE']['count']})")
+    lines += ["", "*По месяцам:*"]
+    for t in get_payment_totals('month')[:SUMMARY_MONTHS]:
+        lines.append(f"• {t['key']}: к оплате {t['NEW']['amount']} ₽, оплачено {t['COMPLETE']['amount']} ₽, "
+                     f"отменено {t['CANCEL']['amount']} ₽")
+    return "\n".join(lines)
+
+@instrument_handler
 def handle_text(message):
-    logger.info(f"Пользователь {message.from_user.id} отправил сообщение: {message.text}")
+    logger.info("Пользователь %s отправил сообщение: %s", message.from_user.id, message.text)
     bot.send_message(message.chat.id, "Сообщение получено, но не обрабатывается.")
 
-# Конструктор кнопок
+# Конструктор кнопок: {'text', 'action', 'id'} → кнопка с подписанной callback_data
 def create_inline_keyboard(buttons):
     markup = InlineKeyboardMarkup()
     for btn in buttons:
-        markup.add(InlineKeyboardButton(btn['text'], callback_data=btn['callback_data']))
+        markup.add(InlineKeyboardButton(btn['text'], callback_data=codec.encode(btn['action'], btn['id'])))
     return markup
 
+def answer_callback(call, text):
+    """Отвечает на нажатие кнопки; тот же ответ получат повторные нажатия (см. throttle.py)"""
+    throttle.remember_answer(call, text)
+    bot.answer_callback_query(call.id, text=text)
+
+def route_callback(call):
+    """Проверяет callback_data и передаёт нажатие обработчику действия.
+
+    Подделанные, чужие и устаревшие кнопки отклоняются до обращения к БД.
+    """
+    decoded = codec.decode(call.data)
+    if decoded is None:
+        logger.warning("Пользователь %s нажал недействительную кнопку: %r", call.from_user.id, call.data)
+        answer_callback(call, "Кнопка устарела. Запросите список заново.")
+        return
+    action, entity_id = decoded
+    CALLBACK_HANDLERS[action](call, entity_id)
+
 # Очистка кнопок в сообщении
 def edit_message_reply_markup(chat_id, message_id):
     try:
@@ -128,37 +281,24 @@ def edit_message_reply_markup(chat_id, message_id):
             reply_markup=None
         )
     except Exception as e:
-        logger.error(f"Ошибка при очистке кнопок в сообщении: {e}")
+        logger.error("Ошибка при очистке кнопок в сообщении: %s", e)
 
 # Обработчик выбора предмета
-@bot.callback_query_handler(func=lambda call: call.data.startswith('subject_'))
-def handle_study_selection(call):
-    logger.info(f"Пользователь {call.from_user.id} выбрал предмет: {call.data}")
-    try:
-        subject_id = int(call.data.replace('subject_', ''))
-    except ValueError:
-        bot.send_message(call.message.chat.id, "❌ Некорректный идентификатор предмета.")
-        return
-
-    bot.answer_callback_query(call.id, text=f"Выбран предмет ID: {subject_id}")
+@instrument_handler
+def handle_study_selection(call, subject_id):
+    logger.info("Пользователь %s выбрал предмет: %s", call.from_user.id, subject_id)
+    answer_callback(call, f"Выбран предмет ID: {subject_id}")
     edit_message_reply_markup(call.message.chat.id, call.message.message_id)
 
-    # Получаем предмет по ID
-    subject = get_subject(subject_id)
-    if not subject:
-        bot.send_message(call.message.chat.id, "❌ Предмет не найден.")
-        return
-
-    # Получаем расписание студента
-    schedule = get_schedule_for_student(call.from_user.id)
-    item = next((s for s in schedule if s['subject_id'] == subject_id), None)
-    if not item:
-        item = next((s for s in get_schedule_for_student(None) if s['subject_id'] == subject_id), None)
+    # Предмет из расписания студента (или дефолтного) вместе с репетитором — один запрос
+    item = get_schedule_item(call.from_user.id, subject_id)
     if not item:
-        bot.send_message(call.message.chat.id, "❌ Не удалось найти информацию о предмете.")
+        if not get_subject(subject_id):
+            bot.send_message(call.message.chat.id, "❌ Предмет не найден.")
+        else:
+            bot.send_message(call.message.chat.id, "❌ Не удалось найти информацию о предмете.")
         return
 
-    tutor = get_tutor(item['tutor_id'])
     price = item['price']
 
     # Формируем событие оплаты
@@ -168,105 +308,228 @@ def handle_study_selection(call):
         'username': call.from_user.username,
         'first_name': call.from_user.first_name,
         'subject_id': subject_id,
-        'tutor_id': tutor['tutor_id'],
+        'tutor_id': item['tutor_id'],
         'price': price
     }
 
     # Сохраняем в БД
-    payment_event_result = add_payment_request(payment_event)
-    logger.info(f"Событие оплаты добавлено в БД: {get_payment_by_id(payment_event_result)}")
-
-    bot.send_message(call.message.chat.id, f"📝 Отлично! Ты выбрал: *{subject['name']}*", parse_mode='Markdown')
-    bot.send_message(call.message.chat.id, f"💰 Стоимость занятия: *{price} ₽*", parse_mode='Markdown')
-    bot.send_message(call.message.chat.id, "Отправляем сообщение родителям — Папа, Мама, оплатите репетитора! 😉")
+    payment_event['id'] = add_payment_request(payment_event)
+    logger.info("Событие оплаты добавлено в БД: %s", payment_event)
+
+    # Сообщения уходят через очередь — обработчик не ждёт ответов Telegram
+    outbox.send_message(
+        call.message.chat.id,
+        f"📝 Отлично! Ты выбрал: *{item['name']}*\n"
+        f"💰 Стоимость занятия: *{price} ₽*\n"
+        f"Отправляем сообщение родителям — Папа, Мама, оплатите репетитора! 😉",
+        parse_mode='Markdown'
+    )
 
     for parent in PAY_LIST:
         if parent != call.from_user.id:
-            try:
-                bot.send_message(parent, f"👤 {call.from_user.first_name} выбрал занятие по предмету: *{subject['name']}*. Стоимость занятия: *{price} ₽*", parse_mode='Markdown')
-            except Exception as e:
-                logger.error(f"Ошибка при отправке сообщения родителю {parent}: {e}")
+            outbox.send_message(parent, f"👤 {call.from_user.first_name} выбрал занятие по предмету: *{item['name']}*. Стоимость занятия: *{price} ₽*", parse_mode='Markdown')
 
 # Обработчик оплаты - детали
-@bot.callback_query_handler(func=lambda call: call.data.startswith('pay_'))
-def handle_payment_details(call):
+@instrument_handler
+def handle_payment_details(call, payment_id):
     edit_message_reply_markup(call.message.chat.id, call.message.message_id)
 
-    payment_id = int(call.data.replace('pay_', ''))
-    req = next((r for r in get_active_payment_requests() if r['id'] == payment_id), None)
+    req = get_active_payment(payment_id)
 
     if not req:
-        bot.answer_callback_query(call.id, text="Ошибка: платёж не найден или уже обработан")
+        answer_callback(call, "Ошибка: платёж не найден или уже обработан")
         return
 
-    tutor = get_tutor(req['tutor_id'])
-
     reply_message = (
         f"📄 *Детали оплаты*\n\n"
         f"📚 Предмет: *{req['subject']}*\n"
-        f"🎓 Репетитор: {tutor['name']}\n"
-        f"🏦 Банк: {tutor['bank']}\n"
+        f"🎓 Репетитор: {req['tutor_name']}\n"
+        f"🏦 Банк: {req['tutor_bank']}\n"
         f"💰 Сумма: {req['price']} ₽\n\n"
         f"Выберите действие:"
     )
 
     buttons = [
-        {'text': '✅ Подтвердить оплату', 'callback_data': f"payConfirm_{payment_id}"},
-        {'text': '🕒 Оплатить позже', 'callback_data': f"payDelay_{payment_id}"},
-        {'text': '❌ Отклонить оплату', 'callback_data': f"payCancel_{payment_id}"}
+        {'text': '✅ Подтвердить оплату', 'action': 'payConfirm', 'id': payment_id},
+        {'text': '🕒 Оплатить позже', 'action': 'payDelay', 'id': payment_id},
+        {'text': '❌ Отклонить оплату', 'action': 'payCancel', 'id': payment_id}
     ]
     markup = create_inline_keyboard(buttons)
 
     bot.send_message(call.message.chat.id, reply_message, parse_mode='Markdown', reply_markup=markup)
 
 # Подтверждение оплаты
-@bot.callback_query_handler(func=lambda call: call.data.startswith('payConfirm_'))
-def handle_payment_confirm(call):
+@instrument_handler
+def handle_payment_confirm(call, payment_id):
     edit_message_reply_markup(call.message.chat.id, call.message.message_id)
-    payment_id = int(call.data.replace('payConfirm_', ''))
-    req = next((r for r in get_active_payment_requests() if r['id'] == payment_id), None)
+    # Проверка статуса и его смена — один атомарный запрос: второй родитель получит «уже обработан»
+    req = transition_payment_status(payment_id, 'COMPLETE')
 
     if req:
-        update_payment_status(payment_id, 'COMPLETE')
-        payment_result = get_payment_by_id (payment_id)
-        logger.info(f"Платёж подтверждён: {payment_result}")
+        logger.info("Платёж подтверждён: %s", req)
 
-        bot.answer_callback_query(call.id, text=f"Оплачено: {req['subject']}")
+        answer_callback(call, f"Оплачено: {req['subject']}")
         bot.send_message(call.message.chat.id, f"✅ Вы оплатили занятие по *{req['subject']}* за *{req['price']} ₽*!", parse_mode='Markdown')
-        bot.send_message(req['user_id'], f"✅ Занятие по *{req['subject']}* оплачено.", parse_mode='Markdown')
+        outbox.send_message(req['user_id'], f"✅ Занятие по *{req['subject']}* оплачено.", parse_mode='Markdown')
 
     else:
-        bot.answer_callback_query(call.id, text="Ошибка: платёж не найден или уже обработан")
+        answer_callback(call, "Ошибка: платёж не найден или уже обработан")
 
 # Отмена оплаты
-@bot.callback_query_handler(func=lambda call: call.data.startswith('payCancel_'))
-def handle_payment_cancel(call):
+@instrument_handler
+def handle_payment_cancel(call, payment_id):
     edit_message_reply_markup(call.message.chat.id, call.message.message_id)
-    payment_id = int(call.data.replace('payCancel_', ''))
-    req = next((r for r in get_active_payment_requests() if r['id'] == payment_id), None)
+    req = transition_payment_status(payment_id, 'CANCEL')
 
     if req:
-        bot.answer_callback_query(call.id, text=f"Отменён платёж: {req['subject']}")
+        answer_callback(call, f"Отменён платёж: {req['subject']}")
         bot.send_message(call.message.chat.id, f"❌ Платёж за *{req['subject']}* отменён.", parse_mode='Markdown')
-        update_payment_status(payment_id, 'CANCEL')
-        logger.info(f"Платёж отменён: {req}")
+        logger.info("Платёж отменён: %s", req)
     else:
-        bot.answer_callback_query(call.id, text="Ошибка: платёж не найден или уже обработан")
+        answer_callback(call, "Ошибка: платёж не найден или уже обработан")
 
 # Отложить оплату
-@bot.callback_query_handler(func=lambda call: call.data.startswith('payDelay_'))
-def handle_payment_delay(call):
+@instrument_handler
+def handle_payment_delay(call, payment_id):
     edit_message_reply_markup(call.message.chat.id, call.message.message_id)
-    payment_id = int(call.data.replace('payDelay_', ''))
-    req = next((r for r in get_active_payment_requests() if r['id'] == payment_id), None)
+    req = get_active_payment(payment_id)
 
     if req:
-        bot.answer_callback_query(call.id, text=f"Отложено: {req['subject']}")
+        # Следующее напоминание о платеже — не раньше чем через REMIND_EVERY_HOURS
+        snooze_payments([payment_id], format_date(datetime.now() + timedelta(hours=REMIND_EVERY_HOURS)))
+        answer_callback(call, f"Отложено: {req['subject']}")
         bot.send_message(call.message.chat.id, f"🕒 Платёж за *{req['subject']}* отложен.", parse_mode='Markdown')
-        logger.info(f"Платёж отложен: {req}")
+        logger.info("Платёж отложен: %s", req)
     else:
-        bot.answer_callback_query(call.id, text="Ошибка: платёж не найден или уже обработан")
+        answer_callback(call, "Ошибка: платёж не найден или уже обработан")
+
+# Действие кнопки (см. callback_codec.ACTIONS) → обработчик(call, id)
+CALLBACK_HANDLERS = {
+    'subject': handle_study_selection,
+    'pay': handle_payment_details,
+    'payConfirm': handle_payment_confirm,
+    'payCancel': handle_payment_cancel,
+    'payDelay': handle_payment_delay,
+}
+
+# === Режим webhook ===
+
+def _update_chat_id(update):
+    """Ключ очереди для обновления: чат, в котором оно произошло"""
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        call = update.callback_query
+        return call.message.chat.id if call.message else call.from_user.id
+    return update.update_id
+
+def create_webhook_app(executor):
+    """WSGI-приложение, принимающее обновления от Telegram и раздающее их пулу потоков"""
+    from flask import Flask, request, abort
+
+    webhook_app = Flask(__name__)
+
+    @webhook_app.route(urlparse(WEBHOOK_URL).path or '/', methods=['POST'])
+    def telegram_webhook():
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret.encode('utf-8'), WEBHOOK_SECRET.encode('utf-8')):
+            abort(403)
+        update = Update.de_json(request.get_data(as_text=True))
+        if not executor.submit(_update_chat_id(update), bot.process_new_updates, [update]):
+            # Очередь чата переполнена — Telegram повторит доставку позже
+            logger.warning("Очередь обработки переполнена, обновление %s отклонено", update.update_id)
+            abort(503)
+        return ''
+
+    @webhook_app.route('/metrics')
+    def metrics_endpoint():
+        if not metrics.scrape_allowed(request.headers.get('Authorization'), METRICS_TOKEN):
+            return 'Unauthorized', 401, {'WWW-Authenticate': 'Bearer'}
+        return metrics.registry.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+    return webhook_app
+
+def start_webhook():
+    """Запускает бота в режиме webhook и возвращает WSGI-приложение для приёма обновлений"""
+    create_bot()
+    scheduler.start()
+    executor = ChatOrderedExecutor(BOT_WORKERS, BOT_QUEUE_SIZE, name='bot-worker', logger=logger)
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    logger.info("Telegram-бот запущен в режиме webhook: %s, обработчиков: %s", WEBHOOK_URL, BOT_WORKERS)
+    return create_webhook_app(executor)
+
+def serve_webhook():
+    """Отдаёт webhook через gunicorn: один процесс-обработчик (бот хранит очереди и лимиты в памяти), WEBHOOK_THREADS потоков.
+
+    Бот создаётся в процессе-обработчике, а не в управляющем: потоки записи, логов и очереди отправки
+    не переживают fork.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class WebhookServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'0.0.0.0:{WEBHOOK_PORT}')
+            self.cfg.set('workers', 1)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', WEBHOOK_THREADS)
+
+        def load(self):
+            return start_webhook()
+
+    WebhookServer().run()
+
+# === Фоновые задачи ===
+
+def format_date(value):
+    """datetime → строка в формате payment_requests.date"""
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+def send_payment_reminders():
+    """Одно сообщение каждому родителю со всеми давно неоплаченными занятиями и кнопками оплаты"""
+    now = datetime.now()
+    due = get_due_reminders(format_date(now - timedelta(hours=REMIND_AFTER_HOURS)), format_date(now))
+    if not due:
+        return
+
+    sent, parents = set(), 0
+    for parent in PAY_LIST:
+        items = [req for req in due if req['user_id'] != parent]
+        if not items:
+            continue
+        lines = ["⏰ Напоминание: есть неоплаченные занятия"]
+        for i, req in enumerate(items, 1):
+            lines.append(f"{i}. {req['date']} — {req['subject']} ({req['first_name']}), {req['price']} ₽")
+        buttons = [{'text': f"Оплатить: {req['subject']} ({req['first_name']})", 'action': 'pay', 'id': req['id']}
+                   for req in items]
+        outbox.send_message(parent, "\n".join(lines), reply_markup=create_inline_keyboard(buttons))
+        sent.update(req['id'] for req in items)
+        parents += 1
+
+    # Следующее напоминание о тех же платежах — через REMIND_EVERY_HOURS
+    snooze_payments(sent, format_date(now + timedelta(hours=REMIND_EVERY_HOURS)))
+    logger.info("Отправлены напоминания об оплате: платежей %s, родителей %s", len(sent), parents)
+
+def archive_payments():
+    moved = archive_settled_payments(ARCHIVE_AFTER_DAYS)
+    if moved:
+        logger.info("Перенесено в архив платежей: %s", moved)
+
 
 if __name__ == '__main__':
-    logger.info("Telegram-бот запущен. Ожидание сообщений...")
-    bot.polling(none_stop=True)
\ No newline at end of file
+    # Только чтение настроек: в режиме webhook бот и логирование поднимаются в процессе gunicorn
+    configure(setup_logs=False)
+    if USE_WEBHOOK:
+        serve_webhook()
+    else:
+        create_bot()
+        scheduler.start()
+        if BOT_MODE == 'webhook':
+            logger.warning("Не заданы WEBHOOK_URL или WEBHOOK_SECRET — бот работает в режиме polling")
+        if METRICS_PORT:
+            metrics.start_metrics_server(METRICS_PORT)
+            logger.info("Метрики доступны на порту %s: /metrics", METRICS_PORT)
+        # getUpdates не работает, пока у бота установлен webhook
+        bot.remove_webhook()
+        logger.info("Telegram-бот запущен. Ожидание сообщений...")
+        bot.polling(none_stop=True)
\ No newline at end of file
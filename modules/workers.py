@@ -0,0 +1,48 @@
+import logging
+import queue
+import threading
+
+
+class ChatOrderedExecutor:
+    """Ограниченный пул потоков с сохранением порядка внутри чата.
+
+    Задачи с одинаковым ключом (chat_id) всегда попадают в одну очередь и выполняются
+    строго по очереди, задачи разных чатов — параллельно. Очереди ограничены:
+    при переполнении submit() возвращает False, а не копит задачи без предела.
+    """
+
+    def __init__(self, workers=4, queue_size=100, name='worker', logger=None):
+        self._logger = logger or logging.getLogger(__name__)
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+        for i, q in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(q,), name=f'{name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, func, *args):
+        """Ставит func(*args) в очередь чата key. Возвращает False, если очередь переполнена"""
+        q = self._queues[hash(key) % len(self._queues)]
+        try:
+            q.put_nowait((func, args))
+        except queue.Full:
+            return False
+        return True
+
+    def shutdown(self, wait=True):
+        """Останавливает потоки после выполнения уже поставленных задач"""
+        for q in self._queues:
+            q.put((None, None))
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _run(self, q):
+        while True:
+            func, args = q.get()
+            if func is None:
+                return
+            try:
+                func(*args)
+            except Exception as e:
+                self._logger.exception("Ошибка при выполнении задачи в %s: %s", threading.current_thread().name, e)
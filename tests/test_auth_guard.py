@@ -0,0 +1,114 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+MODULES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'modules')
+sys.path.insert(0, MODULES_DIR)
+
+import pyotp
+
+import auth_guard
+from auth_guard import LoginLimiter, TotpVerifier, is_code_format
+
+SECRET = 'JBSWY3DPEHPK3PXP'
+
+# Начало 30-секундного интервала, чтобы соседние интервалы считались от точной границы
+NOW = 1_700_000_010
+
+
+class CodeFormatTest(unittest.TestCase):
+    def test_accepts_six_ascii_digits(self):
+        self.assertTrue(is_code_format('012345'))
+
+    def test_rejects_other_input(self):
+        for code in (None, 123456, '', '12345', '1234567', '12345a', '123456\n', '١٢٣٤٥٦', '１２３４５６'):
+            self.assertFalse(is_code_format(code), code)
+
+
+class TotpVerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.totp = pyotp.TOTP(SECRET)
+        self.verifier = TotpVerifier(SECRET)
+        patcher = mock.patch.object(auth_guard.time, 'time', return_value=NOW)
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_accepts_current_code_once(self):
+        code = self.totp.at(NOW)
+        self.assertTrue(self.verifier.verify(code))
+        self.assertFalse(self.verifier.verify(code))
+
+    def test_accepts_adjacent_step(self):
+        self.assertTrue(self.verifier.verify(self.totp.at(NOW - 30)))
+
+    def test_rejects_code_outside_window(self):
+        self.assertFalse(self.verifier.verify(self.totp.at(NOW - 90)))
+        self.assertFalse(self.verifier.verify(self.totp.at(NOW + 90)))
+
+    def test_rejects_older_step_after_login(self):
+        self.assertTrue(self.verifier.verify(self.totp.at(NOW)))
+        self.assertFalse(self.verifier.verify(self.totp.at(NOW - 30)))
+
+    def test_replay_rejected_in_next_interval(self):
+        code = self.totp.at(NOW)
+        self.assertTrue(self.verifier.verify(code))
+        self.clock.return_value = NOW + 30
+        self.assertFalse(self.verifier.verify(code))
+        self.assertTrue(self.verifier.verify(self.totp.at(NOW + 30)))
+
+    def test_rejects_non_ascii_digits(self):
+        self.assertFalse(self.verifier.verify('١٢٣٤٥٦'))
+
+
+class LoginLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.limiter = LoginLimiter(max_failures=3, window_seconds=60, max_keys=2)
+        patcher = mock.patch.object(auth_guard.time, 'monotonic', return_value=1000.0)
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_locks_after_max_failures(self):
+        for _ in range(2):
+            self.limiter.fail('ip')
+        self.assertEqual(self.limiter.retry_after('ip'), 0)
+        self.limiter.fail('ip')
+        self.assertEqual(self.limiter.retry_after('ip'), 60)
+        self.assertEqual(self.limiter.retry_after('other'), 0)
+
+    def test_any_locked_key_blocks(self):
+        for _ in range(3):
+            self.limiter.fail('session')
+        self.assertGreater(self.limiter.retry_after('ip', 'session'), 0)
+
+    def test_sliding_window(self):
+        self.limiter.fail('ip')
+        self.clock.return_value = 1030.0
+        self.limiter.fail('ip')
+        self.limiter.fail('ip')
+        self.assertEqual(self.limiter.retry_after('ip'), 30)
+        # Первая попытка вышла из окна — остались две, блокировка снята
+        self.clock.return_value = 1060.0
+        self.assertEqual(self.limiter.retry_after('ip'), 0)
+        self.limiter.fail('ip')
+        self.assertEqual(self.limiter.retry_after('ip'), 30)
+        self.clock.return_value = 1090.0
+        self.assertEqual(self.limiter.retry_after('ip'), 0)
+
+    def test_reset_clears_failures(self):
+        for _ in range(3):
+            self.limiter.fail('ip', 'session')
+        self.limiter.reset('ip', 'session')
+        self.assertEqual(self.limiter.retry_after('ip', 'session'), 0)
+
+    def test_evicts_oldest_keys(self):
+        for key in ('a', 'b', 'c'):
+            for _ in range(3):
+                self.limiter.fail(key)
+        self.assertEqual(self.limiter.retry_after('a'), 0)
+        self.assertGreater(self.limiter.retry_after('b'), 0)
+        self.assertGreater(self.limiter.retry_after('c'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
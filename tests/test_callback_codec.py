@@ -0,0 +1,76 @@
+import os
+import sys
+import unittest
+
+MODULES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'modules')
+sys.path.insert(0, MODULES_DIR)
+
+import callback_codec
+from callback_codec import CallbackCodec
+
+
+class CallbackCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.codec = CallbackCodec('secret')
+
+    def _resign(self, payload):
+        """callback_data с корректной подписью для произвольного payload"""
+        return f'{payload}.{self.codec._sign(payload)}'
+
+    def test_roundtrip(self):
+        for action in callback_codec.ACTIONS:
+            for entity_id in (0, 1, 35, 36, 3429, 2 ** 40):
+                data = self.codec.encode(action, entity_id)
+                self.assertLessEqual(len(data.encode('utf-8')), callback_codec.MAX_CALLBACK_DATA)
+                self.assertEqual(self.codec.decode(data), (action, entity_id))
+
+    def test_rejects_empty(self):
+        self.assertIsNone(self.codec.decode(None))
+        self.assertIsNone(self.codec.decode(''))
+        self.assertIsNone(self.codec.decode('.'))
+
+    def test_rejects_foreign_key(self):
+        data = CallbackCodec('other').encode('pay', 42)
+        self.assertIsNone(self.codec.decode(data))
+
+    def test_rejects_forged_mac(self):
+        payload, _, mac = self.codec.encode('pay', 42).partition('.')
+        forged = ('A' if mac[0] != 'A' else 'B') + mac[1:]
+        self.assertIsNone(self.codec.decode(f'{payload}.{forged}'))
+
+    def test_rejects_tampered_payload(self):
+        data = self.codec.encode('pay', 42)
+        _, _, mac = data.partition('.')
+        self.assertIsNone(self.codec.decode(f'1p1b.{mac}'))
+        self.assertIsNone(self.codec.decode(f'1c{data[2:]}'))
+
+    def test_rejects_non_ascii(self):
+        payload, _, mac = self.codec.encode('pay', 42).partition('.')
+        self.assertIsNone(self.codec.decode(f'{payload}.{"ж" * len(mac)}'))
+        # Цифры других алфавитов int() принимает, но таких кнопок мы не выпускаем
+        self.assertIsNone(self.codec.decode(self._resign('1p١٢')))
+
+    def test_rejects_wrong_mac_length(self):
+        data = self.codec.encode('pay', 42)
+        self.assertIsNone(self.codec.decode(data[:-1]))
+        self.assertIsNone(self.codec.decode(data + 'A'))
+
+    def test_rejects_other_version(self):
+        self.assertIsNone(self.codec.decode(self._resign('0p16')))
+        self.assertIsNone(self.codec.decode(self._resign('2p16')))
+
+    def test_rejects_unknown_action(self):
+        self.assertNotIn('z', callback_codec.ACTIONS.values())
+        self.assertIsNone(self.codec.decode(self._resign('1z16')))
+
+    def test_rejects_bad_id(self):
+        self.assertIsNone(self.codec.decode(self._resign('1p')))
+        self.assertIsNone(self.codec.decode(self._resign('1p!!')))
+
+    def test_encode_rejects_negative_id(self):
+        with self.assertRaises(ValueError):
+            self.codec.encode('pay', -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+MODULES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'modules')
+sys.path.insert(0, MODULES_DIR)
+
+import storage
+
+# Сколько процессов одновременно обновляют один файл: бот и два веб-процесса
+PROCESSES = 3
+
+
+def _create_baseline(path):
+    """БД в том виде, в каком её создавала версия до миграций: таблицы есть, user_version = 0"""
+    conn = sqlite3.connect(path)
+    for step in storage.MIGRATIONS[0][1]:
+        conn.execute(step)
+    conn.execute("INSERT INTO tutors VALUES ('tutor_0', 'Репетитор', '0 (000) 000-00-00', 'Банк')")
+    conn.execute("INSERT INTO subjects (name) VALUES ('Предмет')")
+    conn.execute("INSERT INTO schedule (student_id, subject_id, tutor_id, price) VALUES (NULL, 1, 'tutor_0', 0)")
+    conn.execute('''
+        INSERT INTO payment_requests (date, user_id, first_name, subject_id, tutor_id, price, status)
+        VALUES ('2025-01-10 10:00:00', 1, 'Ученик', 1, 'tutor_0', 100, 'COMPLETE')
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def _init_db(path, barrier, results):
+    sys.path.insert(0, MODULES_DIR)
+    import storage
+    storage.DB_PATH = path
+    barrier.wait()
+    try:
+        storage.init_db()
+        storage.stop_writer()
+    except Exception as e:
+        results.put(repr(e))
+    else:
+        results.put(None)
+
+
+class ConcurrentMigrationTest(unittest.TestCase):
+
+    def run_concurrently(self, path):
+        context = multiprocessing.get_context('spawn')
+        barrier = context.Barrier(PROCESSES)
+        results = context.Queue()
+        processes = [context.Process(target=_init_db, args=(path, barrier, results)) for _ in range(PROCESSES)]
+        for process in processes:
+            process.start()
+        errors = [results.get(timeout=60) for _ in processes]
+        for process in processes:
+            process.join()
+        self.assertEqual(errors, [None] * PROCESSES)
+
+        conn = sqlite3.connect(path)
+        try:
+            self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], storage.SCHEMA_VERSION)
+            return conn.execute('SELECT COUNT(*) FROM tutors').fetchone()[0], \
+                conn.execute('SELECT COUNT(*) FROM schedule').fetchone()[0], \
+                conn.execute("SELECT count, amount FROM payment_totals WHERE scope = 'student'").fetchall()
+        finally:
+            conn.close()
+
+    def test_upgrade_from_baseline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'tutor_bot.db')
+            _create_baseline(path)
+            tutors, schedule, totals = self.run_concurrently(path)
+            self.assertEqual((tutors, schedule), (1, 1))
+            # Итоги заполнены один раз, а не по разу на процесс
+            self.assertEqual(totals, [(1, 100)])
+
+    def test_fresh_database(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tutors, schedule, _ = self.run_concurrently(os.path.join(tmp, 'database', 'tutor_bot.db'))
+            self.assertEqual((tutors, schedule), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
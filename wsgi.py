@@ -0,0 +1,6 @@
+# wsgi.py
+# Точка входа для WSGI-сервера: gunicorn --workers 1 --threads 8 --bind 0.0.0.0:5000 wsgi:app
+# Процесс должен быть один: TotpVerifier, LoginLimiter, метрики и RotatingFileHandler не делятся между процессами
+from app import create_app
+
+app = create_app()